@@ -0,0 +1,254 @@
+"""
+Benchmarks for teacx and tearipper. Run from the repository root:
+
+    python -m bench [--quick] [--depth 4] [--fanout 4] [--attributes 3] [--output results.json] [--baseline baseline.json] [--save-baseline baseline.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from teacx import read_cx, cx_to_xml, cx_to_json, xml_to_cx
+from util.dump import dump
+from util.mod import package, unpackage
+from bench.corpus import generate_cx, make_game_tree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# results that got slower than the baseline by more than this fraction are reported as regressions
+DEFAULT_THRESHOLD = 0.1
+# the shape of the generated .cx files, see bench.corpus.generate_xml()
+DEFAULT_SHAPE = {'depth': 4, 'fanout': 4, 'attributes': 3}
+
+def count_nodes(node):
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+def measure(fn, setup=None, repeat=3, memory=True):
+    # returns the best time over repeat runs, and the peak memory allocated by python during one more run
+    # (tracemalloc slows everything down, so it's kept out of the timed runs) - or None without memory
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if not memory:
+        return best, None
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def result(seconds, peak, size=None, nodes=None, files=None):
+    res = {'seconds': round(seconds, 6), 'peak_memory': peak}
+    if size is not None:
+        res['bytes'] = size
+        res['mb_per_s'] = round(size / seconds / 1e6, 3)
+    if nodes is not None:
+        res['nodes'] = nodes
+        res['nodes_per_s'] = round(nodes / seconds)
+    if files is not None:
+        res['files'] = files
+        res['files_per_s'] = round(files / seconds, 3)
+    return res
+
+def bench_cx(size, repeat, shape):
+    data, xml = generate_cx(size, **shape)
+    path = os.path.join(tempfile.mkdtemp(prefix='teabench'), 'bench.cx')
+    with open(path, 'wb') as f:
+        f.write(data)
+    file = xml_to_cx(xml)
+    nodes = count_nodes(file.root_node)
+    results = {}
+
+    def read():
+        with open(path, 'rb') as f:
+            read_cx(f)
+
+    results['read_cx'] = result(*measure(read, repeat=repeat), len(data), nodes)
+    results['serialise'] = result(*measure(file.serialise, repeat=repeat), len(data), nodes)
+    results['cx_to_xml'] = result(*measure(cx_to_xml, lambda: (file,), repeat), len(data), nodes)
+    results['cx_to_json'] = result(*measure(cx_to_json, lambda: (file,), repeat), len(data), nodes)
+    results['xml_to_cx'] = result(*measure(xml_to_cx, lambda: (xml,), repeat), len(xml.encode('utf-8')), nodes)
+    shutil.rmtree(os.path.dirname(path))
+    return results
+
+def bench_tree(scale, repeat, shape):
+    # dump, package and unpackage all work relative to the working directory (registry keys are relative
+    # paths), so this runs in a scratch directory, with the mod directory called 'latest' like the game's own
+    results = {}
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix='teabench')
+    os.chdir(work)
+    try:
+        size = make_game_tree('game', cx_files=20 * scale, snd_files=10 * scale, tga_files=10 * scale, bmp_files=10 * scale, cx_shape=shape)
+
+        def fresh_copy():
+            shutil.rmtree('latest', ignore_errors=True)
+            shutil.copytree('game', 'latest')
+            return ()
+
+        # everything runs in this process (jobs=1), so times don't depend on the number of cores and the peak
+        # memory covers all of the work
+        results['dump'] = result(*measure(lambda: dump('latest', overwrite=True, jobs=1), fresh_copy, repeat), size)
+
+        # the mod changes a few attributes in every cx file and rewrites the first half of every texture
+        with open(os.path.join('latest', 'bench.mod.json'), 'w') as f:
+            json.dump({'id': 'bench', 'name': 'Benchmark', 'author': '', 'description': '', 'version': 0}, f)
+        changed = 0
+        for root, dirs, files in os.walk('latest'):
+            for file in files:
+                path = os.path.join(root, file)
+                if file.endswith('.xml'):
+                    with open(path, 'r') as f:
+                        xml = f.read()
+                    with open(path, 'w') as f:
+                        f.write(xml.replace('name0="', 'name0="1', 10))
+                elif file.endswith('.tex'):
+                    with open(path, 'r+b') as f:
+                        half = os.path.getsize(path) // 2
+                        f.write(bytes(half))
+                        changed += half
+
+        def package_setup():
+            if os.path.exists('bench.teamod'):
+                os.remove('bench.teamod')
+            return ()
+
+        results['package'] = result(*measure(lambda: package('latest', output_path='bench.teamod', jobs=1), package_setup, repeat), changed)
+
+        def unpackage_setup():
+            shutil.rmtree('installed', ignore_errors=True)
+            shutil.rmtree('backup', ignore_errors=True)
+            shutil.copytree('game', 'installed')
+            return ()
+
+        results['unpackage'] = result(*measure(lambda: unpackage('bench.teamod', 'installed', show_virus_warning=False), unpackage_setup, repeat), os.path.getsize('bench.teamod'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+def run_python(*args):
+    subprocess.run([sys.executable, *args], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+def bench_startup(files, repeat, shape):
+    # the command line tools are mostly run from scripts, once per file - so this is the time to start teacx, and
+    # how much of it a batch of files in one run saves. peak memory isn't measured, it's another process's
+    results = {}
+    work = tempfile.mkdtemp(prefix='teabench')
+    try:
+        paths = []
+        for i in range(files):
+            data, _ = generate_cx(8 * 1024, seed=i, **shape)
+            paths.append(os.path.join(work, f'file{i}.cx'))
+            with open(paths[-1], 'wb') as f:
+                f.write(data)
+        teacx_path = os.path.join(ROOT, 'teacx.py')
+        results['startup_import'] = result(*measure(lambda: run_python('-c', 'import teacx'), repeat=repeat, memory=False))
+        results['startup_help'] = result(*measure(lambda: run_python(teacx_path, '--help'), repeat=repeat, memory=False))
+
+        def one_by_one():
+            for path in paths:
+                run_python(teacx_path, 'deserialise', '-j', path)
+
+        results['deserialise_per_file'] = result(*measure(one_by_one, repeat=repeat, memory=False), files=files)
+        results['deserialise_batch'] = result(*measure(lambda: run_python(teacx_path, 'deserialise', '-j', *paths), repeat=repeat, memory=False), files=files)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # returns {name: time / baseline time} for every benchmark in both, and the names that got slower than
+    # threshold allows
+    ratios = {}
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or not base.get('seconds'):
+            continue
+        ratios[name] = round(res['seconds'] / base['seconds'], 3)
+        if ratios[name] > 1 + threshold:
+            regressions.append(name)
+    return ratios, regressions
+
+def run(quick=False, repeat=3, only=None, shape=None):
+    shape = dict(DEFAULT_SHAPE, **(shape or {}))
+    benches = {
+        'cx': lambda: bench_cx(256 * 1024 if quick else 4 * 1024 * 1024, repeat, shape),
+        'tree': lambda: bench_tree(1 if quick else 5, repeat, shape),
+        'startup': lambda: bench_startup(10 if quick else 50, repeat, shape),
+    }
+    results = {}
+    for name, bench in benches.items():
+        if only is None or name in only:
+            # the tools print a line per file, which would be timed as well
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.update(bench())
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'repeat': repeat,
+        'shape': shape,
+        'results': results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Benchmark teacx and tearipper on synthetic files')
+    parser.add_argument('--quick', action='store_true', help='use a small corpus (for checking that the benchmarks work, not for comparing results)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark, the best is kept (default: 3)')
+    parser.add_argument('--depth', type=int, default=DEFAULT_SHAPE['depth'], help=f'levels in each subtree of the generated cx files (default: {DEFAULT_SHAPE["depth"]})')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_SHAPE['fanout'], help=f'children of every node in the generated cx files (default: {DEFAULT_SHAPE["fanout"]})')
+    parser.add_argument('--attributes', type=int, default=DEFAULT_SHAPE['attributes'], help=f'most attributes on a node in the generated cx files (default: {DEFAULT_SHAPE["attributes"]})')
+    parser.add_argument('--only', nargs='+', choices=['cx', 'tree', 'startup'], help='only run these groups of benchmarks (default: all)')
+    parser.add_argument('--output', help='write the results to a JSON file (default: print them)')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', help='also save the results as a baseline for later runs')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help=f'fraction a benchmark can be slower than the baseline before it counts as a regression (default: {DEFAULT_THRESHOLD})')
+    args = parser.parse_args()
+    if not 1 <= args.depth <= 255:
+        parser.error('--depth must be between 1 and 255, lxml won\'t parse XML nested any deeper')
+
+    report = run(args.quick, args.repeat, args.only, {'depth': args.depth, 'fanout': args.fanout, 'attributes': args.attributes})
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('shape', DEFAULT_SHAPE) != report['shape']:
+            print(f'Warning: the baseline was run on cx files of another shape ({baseline.get("shape", DEFAULT_SHAPE)})', file=sys.stderr)
+        report['baseline'], regressions = compare(report['results'], baseline, args.threshold)
+        report['regressions'] = regressions
+    text = json.dumps(report, indent=4)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({key: report[key] for key in ('python', 'platform', 'quick', 'repeat', 'shape', 'results')}, f, indent=4)
+    if regressions:
+        print(f'Slower than the baseline: {", ".join(regressions)}', file=sys.stderr)
+        exit(1)
+
+if __name__ == '__main__':
+    main()
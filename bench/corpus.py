@@ -0,0 +1,105 @@
+import os
+import random
+import struct
+from teacx import xml_to_cx
+
+# synthetic inputs for the benchmarks - everything is generated from a seed, so the same arguments always give
+# the same bytes and results from different runs can be compared
+
+TAGS = ['library', 'weapon', 'item', 'sound', 'mesh', 'a.b', 'texture', 'actor']
+ATTRIBUTES = ['name', 'value', 'id', 'damage', 'x.y', 'path', 'speed', 'colour']
+
+def generate_xml(size, depth=4, fanout=4, attributes=3, seed=0):
+    """
+    Returns an XML document of at least size bytes: a root node with as many subtrees as it takes, each depth
+    levels deep with fanout children per node and up to attributes attributes on every node.
+    """
+    r = random.Random(seed)
+    out = ['<library name="bench">']
+    length = len(out[0])
+
+    def subtree(level, indent):
+        # iterative, so any depth works - the stack holds nodes still to write and the closing tags of open ones
+        nonlocal length
+        stack = [(level, indent, None)]
+        while stack:
+            level, indent, closing = stack.pop()
+            if closing is not None:
+                out.append(closing)
+                length += len(closing) + 1
+                continue
+            tag = r.choice(TAGS)
+            attrs = ''.join(f' {r.choice(ATTRIBUTES)}{i}="{r.randint(0, 99999)}"' for i in range(r.randint(0, attributes)))
+            if level == 0:
+                line = f'{indent}<{tag}{attrs}/>'
+                out.append(line)
+                length += len(line) + 1
+                continue
+            line = f'{indent}<{tag}{attrs}>'
+            out.append(line)
+            length += len(line) + 1
+            stack.append((level, indent, f'{indent}</{tag}>'))
+            stack.extend([(level - 1, indent + '  ', None)] * fanout)
+
+    while length < size:
+        subtree(depth - 1, '  ')
+    out.append('</library>')
+    return '\n'.join(out)
+
+def generate_cx(size, depth=4, fanout=4, attributes=3, seed=0, original_path='system\\bench.xml'):
+    # returns (cx bytes, the xml it was made from)
+    xml = generate_xml(size, depth, fanout, attributes, seed)
+    return xml_to_cx(xml, original_path=original_path).serialise(), xml
+
+def generate_ogg(size, seed=0):
+    # ogg pages with random payloads - enough for the carver, not something a player would play
+    r = random.Random(seed)
+    pages = []
+    flags = 2
+    total = 0
+    while total < size:
+        payload = r.randbytes(min(255 * 16, size - total) or 1)
+        segments = [255] * (len(payload) // 255) + [len(payload) % 255]
+        total += len(payload)
+        if total >= size:
+            flags |= 4
+        pages.append(struct.pack('<4sBBqIIIB', b'OggS', 0, flags, 0, seed, len(pages), 0, len(segments)) + bytes(segments) + payload)
+        flags = 0
+    return b''.join(pages)
+
+def generate_snd(size, seed=0):
+    r = random.Random(seed)
+    return r.randbytes(64) + generate_ogg(size, seed)
+
+def generate_tga(size, seed=0):
+    r = random.Random(seed)
+    return r.randbytes(max(0, size - 18)) + b'TRUEVISION-XFILE.\x00'
+
+def generate_bmp(size, seed=0):
+    r = random.Random(seed)
+    return b'BM' + r.randbytes(max(0, size - 2))
+
+def make_game_tree(root, cx_files=20, cx_size=64 * 1024, snd_files=10, snd_size=256 * 1024, tga_files=10, tga_size=512 * 1024, bmp_files=10, bmp_size=256 * 1024, seed=0, cx_shape=None):
+    """
+    Writes a fake game directory to root - system/*.cx, sounds/*.snd, textures/*.tex (TGAs) and textures/*.img
+    (BMPs), named the way the game doesn't name them so dump has to detect them. cx_shape is passed on to
+    generate_cx() (depth, fanout, attributes). Returns the total size.
+    """
+    total = 0
+    for folder in ('system', 'sounds', 'textures'):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    for i in range(cx_files):
+        data, _ = generate_cx(cx_size, seed=seed + i, original_path=f'system\\file{i}.xml', **(cx_shape or {}))
+        total += write(os.path.join(root, 'system', f'file{i}.cx'), data)
+    for i in range(snd_files):
+        total += write(os.path.join(root, 'sounds', f'sound{i}.snd'), generate_snd(snd_size, seed + i))
+    for i in range(tga_files):
+        total += write(os.path.join(root, 'textures', f'texture{i}.tex'), generate_tga(tga_size, seed + i))
+    for i in range(bmp_files):
+        total += write(os.path.join(root, 'textures', f'image{i}.img'), generate_bmp(bmp_size, seed + i))
+    return total
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
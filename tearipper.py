@@ -1,12 +1,27 @@
 import argparse
-from util.dump import dump, decode
+import cProfile
+import multiprocessing
+import pstats
+from util.metrics import metrics, set_quiet
+from util.dump import dump, decode, inventory
+from util.registry import export_registry, import_registry, list_registry, diff_registries
 from util.mod import package, init, unpackage, play
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support() # needed for worker processes in the PyInstaller build
     parser = argparse.ArgumentParser(description='Extract, decode, dump, and package modified files for Tea for God modding.')
     subparsers = parser.add_subparsers(dest='action', required=True)
+    # options for the commands that work through a whole game directory or mod
+    run_parser = argparse.ArgumentParser(add_help=False)
+    run_parser.add_argument('-q', '--quiet', action='store_true', help='only print warnings and errors')
+    run_parser.add_argument('--metrics', help='save the time spent in each stage and on each file to a JSON file')
+    run_parser.add_argument('--profile', nargs='?', const='tearipper.prof', help='run under cProfile, print the slowest functions and save the stats to a file (default: tearipper.prof)')
+    # options for the commands that decode cx files
+    cx_cache_parser = argparse.ArgumentParser(add_help=False)
+    cx_cache_parser.add_argument('--cx-cache', metavar='DIR', help='keep decoded cx files in this directory, so unchanged files are never decoded twice (default: no cache)')
+    cx_cache_parser.add_argument('--cx-cache-size', type=int, default=1024, metavar='MB', help='size the cx cache is kept under, least recently used files are removed first (default: 1024)')
 
-    dump_parser = subparsers.add_parser('dump', help='dump all encoded files from a game directory recursively')
+    dump_parser = subparsers.add_parser('dump', parents=[run_parser, cx_cache_parser], help='dump all encoded files from a game directory recursively')
     dump_parser.add_argument('directory', help='directory to dump files from')
     dump_parser.add_argument('--output', help='output directory to dump files to (default: passed directory, same folders and structure as input files)')
     dump_parser.add_argument('--overwrite', action='store_true', help='overwrite existing files in output directory')
@@ -14,43 +29,101 @@ if __name__ == '__main__':
     dump_parser.add_argument('--reg-path', help='path to save teareg registry file for later packaging (default: passed directory/dump.teareg)')
     dump_parser.add_argument('-j', '--use-json', action='store_true', help='use json for cx deserialization for better accuracy (default: xml)')
     dump_parser.add_argument('-m', '--mod', action='store_true', help='create configuration files for a mod (default: none created, you can create them manually later with the init command)')    
+    dump_parser.add_argument('--jobs', type=int, help='number of files to process at once in separate processes (default: CPU count)')
+    dump_parser.add_argument('-i', '--incremental', action='store_true', help='only process files that changed since the last dump, using the cache saved next to the registry')
+    dump_parser.add_argument('--json-registry', action='store_true', help='save the registry in the old json format instead of sqlite (slower to query, but readable by older versions)')
 
-    decode_parser = subparsers.add_parser('decode', help='decode a single file')
+    decode_parser = subparsers.add_parser('decode', parents=[cx_cache_parser], help='decode a single file')
     decode_parser.add_argument('file', help='file to decode')
     decode_parser.add_argument('-j', '--use-json', action='store_true', help='use json for cx deserialization for better accuracy (default: xml)')
 
-    package_parser = subparsers.add_parser('package', help='package a dumped directory into a mod file')
+    inventory_parser = subparsers.add_parser('inventory', help='list the headers (version, build, digests) of all cx files in a directory, without decoding them')
+    inventory_parser.add_argument('directory', help='directory to inventory recursively')
+    inventory_parser.add_argument('--output', help='write the inventory to a JSON file instead of printing a table')
+    inventory_parser.add_argument('--jobs', type=int, help='number of files to read at once (default: depends on CPU count)')
+
+    registry_parser = subparsers.add_parser('registry', help='inspect, compare and convert teareg registry files')
+    registry_subparsers = registry_parser.add_subparsers(dest='registry_action')
+    registry_list_parser = registry_subparsers.add_parser('list', help='list the files (and their hashes) in a registry')
+    registry_list_parser.add_argument('file', help='registry file to list')
+    registry_list_parser.add_argument('directory', nargs='?', default='', help='only list files in this directory (default: all files)')
+    registry_diff_parser = registry_subparsers.add_parser('diff', help='show the files that were added, modified or deleted between two registries')
+    registry_diff_parser.add_argument('old', help='older registry file')
+    registry_diff_parser.add_argument('new', help='newer registry file')
+    registry_export_parser = registry_subparsers.add_parser('export', help='convert a registry to the old json format')
+    registry_export_parser.add_argument('file', help='registry file to export')
+    registry_export_parser.add_argument('output', help='json file to write')
+    registry_import_parser = registry_subparsers.add_parser('import', help='convert an old json registry to the sqlite format')
+    registry_import_parser.add_argument('file', help='json registry file to import')
+    registry_import_parser.add_argument('output', help='registry file to write')
+
+    package_parser = subparsers.add_parser('package', parents=[run_parser], help='package a dumped directory into a mod file')
     package_parser.add_argument('directory', help='directory to package')
     package_parser.add_argument('--reg-path', help='path to teareg registry file to use for packaging (default: passed directory/dump.teareg)')
     package_parser.add_argument('--config', help='configuration file to use for packaging (default: passed directory/<config name>.mod.json)')
     package_parser.add_argument('--output', help='output file to package to (default: <config name>.teamod)')
+    package_parser.add_argument('--jobs', type=int, help='number of files to hash at once (default: CPU count)')
+    package_parser.add_argument('--delta-base', help='unmodified game directory - changed files whose original is found there are packaged as binary deltas against it')
+    package_parser.add_argument('--whole-cx', action='store_true', help='package changed cx files whole instead of as patches against the game\'s files')
+    package_parser.add_argument('--trust-mtime', action='store_true', help='assume files whose size and modification time match the registry are unchanged, instead of hashing them')
     package_parser.add_argument('--pause-before-zip', action='store_true', help='pause before zipping to allow for manual file changes')
 
     init_parser = subparsers.add_parser('init', help='initialize a mod configuration file (interactive, cannot be used automatically!)')
     init_parser.add_argument('directory', help='directory to initialize configuration file in')
 
-    unpackage_parser = subparsers.add_parser('unpackage', help='unpackage a mod file into a directory')
+    unpackage_parser = subparsers.add_parser('unpackage', parents=[run_parser], help='unpackage a mod file into a directory')
     unpackage_parser.add_argument('file', help='file to unpackage')
     unpackage_parser.add_argument('output', help='output directory to unpackage to')
 
-    play_parser = subparsers.add_parser('play', help='launch the game with mods active')
+    play_parser = subparsers.add_parser('play', parents=[run_parser], help='launch the game with mods active')
     play_parser.add_argument('directory', help='path to game files')
     play_parser.add_argument('mods', help='path to directory containing mods to load')
+    play_parser.add_argument('--overlay', action='store_true', help='run the game from a staged copy of the game directory made of links, instead of swapping mod files in and out of it')
+    play_parser.add_argument('--cache-dir', default='modcache', help='directory to keep extracted mods and activation plans in (default: modcache)')
 
     args = parser.parse_args()
+    set_quiet(getattr(args, 'quiet', False))
+    metrics_path = getattr(args, 'metrics', None)
+    profiler = None
+    if getattr(args, 'profile', None) is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    if args.action == 'dump':
-        dump(args.directory, args.output, args.overwrite, args.skip_existing, args.reg_path, args.mod, args.use_json)
-    elif args.action == 'decode':
-        decode(args.file, args.use_json)
-    elif args.action == 'package':
-        package(args.directory, args.reg_path, args.config, args.output, pause_before_zip=args.pause_before_zip)
-    elif args.action == 'init':
-        init(args.directory)
-    elif args.action == 'unpackage':
-        unpackage(args.file, args.output, interactive_warning=True)
-    elif args.action == 'play':
-        play(args.directory, args.mods)
-    else:
-        parser.print_help()
-        exit(1)
\ No newline at end of file
+    try:
+        if args.action == 'dump':
+            dump(args.directory, args.output, args.overwrite, args.skip_existing, args.reg_path, args.mod, args.use_json, args.jobs, args.incremental, args.json_registry, args.cx_cache, args.cx_cache_size * 1024 * 1024)
+        elif args.action == 'decode':
+            decode(args.file, args.use_json, args.cx_cache, args.cx_cache_size * 1024 * 1024)
+        elif args.action == 'inventory':
+            inventory(args.directory, args.output, args.jobs)
+        elif args.action == 'registry':
+            if args.registry_action == 'list':
+                list_registry(args.file, args.directory)
+            elif args.registry_action == 'diff':
+                diff_registries(args.old, args.new)
+            elif args.registry_action == 'export':
+                export_registry(args.file, args.output)
+            elif args.registry_action == 'import':
+                import_registry(args.file, args.output)
+            else:
+                registry_parser.print_help()
+                exit(1)
+        elif args.action == 'package':
+            package(args.directory, args.reg_path, args.config, args.output, pause_before_zip=args.pause_before_zip, jobs=args.jobs, cx_patches=not args.whole_cx, delta_base=args.delta_base, trust_mtime=args.trust_mtime)
+        elif args.action == 'init':
+            init(args.directory)
+        elif args.action == 'unpackage':
+            unpackage(args.file, args.output, interactive_warning=True)
+        elif args.action == 'play':
+            play(args.directory, args.mods, args.cache_dir, args.overlay)
+        else:
+            parser.print_help()
+            exit(1)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            if not args.quiet:
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+        if metrics_path is not None:
+            metrics.save(metrics_path)
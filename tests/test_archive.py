@@ -0,0 +1,47 @@
+import os
+import threading
+import zipfile
+from util.mod import compress_member, write_compressed_member
+from util.parallel import ordered_map
+
+def test_compressed_members_make_a_valid_archive(tmp_path):
+    # write_compressed_member works on zipfile's private state - this is what has to keep passing before
+    # compressed_member_versions can take in a new Python version
+    members = []
+    for i in range(12):
+        path = tmp_path / f'file{i}.txt'
+        path.write_bytes(os.urandom(64) + b'repeated text ' * 5000 * (i + 1))
+        members.append((str(path), f'dir/file{i}.txt'))
+    (tmp_path / 'empty.txt').write_bytes(b'')
+    members.append((str(tmp_path / 'empty.txt'), 'empty.txt'))
+    archive = tmp_path / 'out.zip'
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for n, ((path, arcname), (zinfo, data, _)) in enumerate(zip(members, ordered_map(compress_member, members, 4, threads=True))):
+            write_compressed_member(zf, zinfo, data)
+            if n % 4 == 0: # mixed with members zipfile writes itself
+                zf.writestr(f'meta{n}.json', '{}')
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.testzip() is None
+        for path, arcname in members:
+            with open(path, 'rb') as f:
+                assert zf.read(arcname) == f.read()
+        assert zf.read('meta0.json') == b'{}'
+
+def test_ordered_map_caps_weight_in_flight():
+    lock = threading.Lock()
+    in_flight = [0, 0] # now, most at once
+
+    def work(size):
+        with lock:
+            in_flight[0] += size
+            in_flight[1] = max(in_flight)
+        return size
+
+    results = []
+    for size in ordered_map(work, [(100,)] * 50, 4, threads=True, weight=lambda size: size, max_weight=350):
+        with lock:
+            in_flight[0] -= size
+        results.append(size)
+    assert results == [100] * 50
+    # the call that takes it over the limit is the last one submitted
+    assert in_flight[1] <= 350 + 100
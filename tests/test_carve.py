@@ -0,0 +1,48 @@
+import struct
+from util.carve import carve, mapped, mpeg_frame_length, write_streams
+from bench.corpus import generate_ogg
+
+NOISE = bytes(range(0x20, 0x7f)) * 4 # no signature in it, or anything that looks like an MPEG header
+
+def mpeg(frames):
+    header = 0xfffb9000 # MPEG-1 layer III, 128 kbps, 44.1 kHz
+    frame = struct.pack('>I', header) + bytes(mpeg_frame_length(header) - 4)
+    return frame * frames
+
+def wav(size):
+    return b'RIFF' + struct.pack('<I', size + 4) + b'WAVE' + bytes(size)
+
+def id3(frames):
+    return b'ID3\x03\x00\x00\x00\x00\x00\x10' + bytes(16) + mpeg(frames)
+
+def test_finds_every_stream():
+    streams = [(generate_ogg(5000), 'ogg'), (wav(3000), 'wav'), (id3(2), 'mp3'), (mpeg(5), 'mp3'), (generate_ogg(100, seed=1), 'ogg')]
+    data = b''
+    expected = []
+    for stream, ext in streams:
+        data += NOISE
+        expected.append((len(data), len(data) + len(stream), ext))
+        data += stream
+    data += NOISE
+    assert carve(data) == expected
+
+def test_ignores_short_runs_of_bare_mpeg_frames():
+    assert carve(NOISE + mpeg(2) + NOISE) == []
+
+def test_nothing_to_find():
+    assert carve(b'') == []
+    assert carve(NOISE) == []
+    assert carve(b'OggS\x00' + NOISE) == [] # a signature with no stream behind it
+
+def test_writes_streams_from_a_mapped_file(tmp_path):
+    ogg = generate_ogg(5000)
+    path = tmp_path / 'sound.snd'
+    path.write_bytes(NOISE + ogg + NOISE + wav(100))
+    with mapped(str(path)) as data:
+        streams = carve(data)
+        write_streams(data, streams, [str(tmp_path / f'{i}.out') for i in range(len(streams))])
+    assert [ext for _, _, ext in streams] == ['ogg', 'wav']
+    assert (tmp_path / '0.out').read_bytes() == ogg
+    (tmp_path / 'empty.snd').write_bytes(b'')
+    with mapped(str(tmp_path / 'empty.snd')) as data:
+        assert carve(data) == []
@@ -0,0 +1,70 @@
+import io
+from teacx import json_to_cx, json_to_node, json_events, cx_to_json, apply_cx_diff, header_to_json, xml_to_header, iterparse_cx, write_xml, xml_events, events_to_cx, diff_cx, diffs_conflict, EVENT_NAMES
+
+def node(type, content, attributes=(), children=()):
+    return {'line_number': 1, 'type': type, 'content': content, 'attributes': [{'name': k, 'value': v} for k, v in attributes], 'children': list(children)}
+
+def game_file():
+    # the things real game files have that XML has trouble with: comments next to the root element, and
+    # commented-out nodes (nested ones too)
+    root = node('Root (Virtual)', '', children=[
+        node('Comment', 'generated, do not edit'),
+        node('Node', 'library', [('name', 'weapons')], [
+            node('Node', 'weapon', [('name', 'sword'), ('damage', '10')]),
+            node('Commented-out Node', 'weapon', [('name', 'axe'), ('note', 'old--unused')], [
+                node('Node', 'part', [('name', 'blade')]),
+                node('Commented-out Node', 'part', [('name', 'handle')]),
+            ]),
+            node('Comment', 'ranged'),
+            node('Node', 'weapon', [('name', 'bow'), ('damage', '4')], [node('Text', 'a bow')]),
+        ]),
+        node('Comment', 'end of file'),
+    ])
+    return json_to_cx({'header': header_to_json(xml_to_header('', 'system\\weapons.xml')), 'node': root})
+
+def dump(file):
+    # the same way dump writes it
+    out = io.StringIO()
+    write_xml(iterparse_cx(file.serialise(), events=EVENT_NAMES), out)
+    return out.getvalue()
+
+def package(xml):
+    # the same way package reads it
+    return events_to_cx(xml_events(xml, original_path='system\\weapons.xml'))
+
+def test_unedited_dump_has_empty_diff():
+    file = game_file()
+    assert diff_cx(file, package(dump(file))) == []
+
+def test_edits_to_different_nodes_dont_conflict():
+    file = game_file()
+    xml = dump(file)
+    sword = diff_cx(file, package(xml.replace('damage="10"', 'damage="12"')))
+    bow = diff_cx(file, package(xml.replace('damage="4"', 'damage="5"')))
+    assert sword == [{'op': 'set', 'path': [['library', 'weapons', 0], ['weapon', 'sword', 0]], 'name': 'damage', 'value': '12'}]
+    assert len(bow) == 1
+    assert not diffs_conflict(sword, bow)
+
+def deep_file(depth):
+    leaf = node('Node', 'leaf')
+    for i in range(depth):
+        leaf = node('Node', 'level', [('name', str(i))], [leaf])
+    return {'header': header_to_json(xml_to_header('', 'system\\deep.xml')), 'node': node('Root (Virtual)', '', children=[leaf])}
+
+def test_deep_files():
+    data = deep_file(3000)
+    file = json_to_cx(data)
+    assert file.serialise() == events_to_cx(json_events(data)).serialise()
+    # an insert and a replace deep down both go through json_to_node
+    new = json_to_cx(deep_file(3000))
+    innermost = new.root_node
+    while innermost.children:
+        innermost = innermost.children[0]
+    innermost.children.append(json_to_node(deep_file(3000)['node']))
+    ops = diff_cx(file, new)
+    assert [op['op'] for op in ops] == ['insert']
+    assert apply_cx_diff(file, ops) == []
+    assert file.serialise() == new.serialise()
+    replaced = json_to_cx(deep_file(3000))
+    assert apply_cx_diff(replaced, [{'op': 'replace', 'path': [], 'node': cx_to_json(new)['node']}]) == []
+    assert replaced.serialise() == new.serialise()
@@ -0,0 +1,108 @@
+import gc
+import io
+import threading
+import pytest
+import teacx
+from teacx import CXFile, decode_cx, decode_cx_compact, read_cx, iterparse_cx, events_to_cx, write_cx, json_to_cx, header_to_json, xml_to_header, EVENT_NAMES
+from bench.corpus import generate_cx
+
+def test_gc_paused_until_last_concurrent_decode_ends(monkeypatch):
+    data, _ = generate_cx(4096)
+    walk = teacx._walk_node_list
+    started = threading.Barrier(2)
+    first_done = threading.Event()
+    seen = []
+
+    def slow_walk(*args):
+        started.wait()
+        if threading.current_thread().name == 'second':
+            first_done.wait()
+            seen.append(gc.isenabled()) # the first decode has finished, this one is still going
+        return walk(*args)
+
+    def decode():
+        teacx.decode_cx(data)
+        if threading.current_thread().name == 'first':
+            first_done.set()
+
+    monkeypatch.setattr(teacx, '_walk_node_list', slow_walk)
+    assert gc.isenabled()
+    threads = [threading.Thread(target=decode, name=name) for name in ('first', 'second')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == [False]
+    assert gc.isenabled()
+
+def test_gc_left_off_if_it_was_off():
+    data, _ = generate_cx(4096)
+    gc.disable()
+    try:
+        teacx.decode_cx(data)
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+
+SHAPES = [
+    {'depth': 4, 'fanout': 4, 'attributes': 3},
+    {'depth': 1, 'fanout': 1, 'attributes': 0},
+    {'depth': 12, 'fanout': 1, 'attributes': 8},
+    {'depth': 3, 'fanout': 9, 'attributes': 1},
+]
+
+def node(type, content, attributes=(), children=()):
+    return {'line_number': 7, 'type': type, 'content': content, 'attributes': [{'name': k, 'value': v} for k, v in attributes], 'children': list(children)}
+
+def odd_file():
+    # every node type, empty strings and non-ASCII text - things the generated files don't have
+    root = node('Root (Virtual)', '', children=[
+        node('Comment', ''),
+        node('Node', 'library', [('name', ''), ('', 'x'), ('unicode', 'é ✓ 😀')], [
+            node('Text', 'some text'),
+            node('Commented-out Node', 'old', [('name', 'a--b')], [node('Node', 'part')]),
+            node('Node', 'empty'),
+        ]),
+    ])
+    return json_to_cx({'header': header_to_json(xml_to_header('header text', 'system\\odd.xml')), 'node': root}).serialise()
+
+FILES = [generate_cx(16 * 1024, seed=i, **shape)[0] for i, shape in enumerate(SHAPES)] + [odd_file()]
+
+def per_field_decode(data):
+    # the decoder every CXSerialisable class has had from the start, one field and one read() at a time
+    return CXFile().deserialise(io.BytesIO(data))
+
+def per_field_serialise(node):
+    # likewise, the original serialiser: every field's own serialise(), children after their parent
+    out = [node.line_number.serialise(), node.type.serialise(), node.content.serialise()]
+    node.attribute_count.value = len(node.attributes)
+    out.append(node.attribute_count.serialise())
+    out += [attr.serialise() for attr in node.attributes]
+    node.child_count.value = len(node.children)
+    out.append(node.child_count.serialise())
+    out += [per_field_serialise(child) for child in node.children]
+    return b''.join(out)
+
+def fields(obj):
+    if isinstance(obj, list):
+        return [fields(item) for item in obj]
+    if hasattr(obj, '__dict__'):
+        return type(obj).__name__, {key: fields(value) for key, value in vars(obj).items()}
+    return obj
+
+@pytest.mark.parametrize('data', FILES)
+def test_decoders_agree_with_per_field_decoder(data):
+    expected = per_field_decode(data)
+    assert fields(decode_cx(data).root_node) == fields(expected.root_node)
+    assert fields(read_cx(io.BytesIO(data)).root_node) == fields(expected.root_node)
+    assert decode_cx(data).header.serialise() == expected.header.serialise()
+
+@pytest.mark.parametrize('data', FILES)
+def test_round_trips_are_byte_identical(data):
+    file = decode_cx(data)
+    assert file.serialise() == data
+    assert file.header.serialise() + per_field_serialise(per_field_decode(data).root_node) == data
+    assert events_to_cx(iterparse_cx(data, events=EVENT_NAMES)).serialise() == data
+    out = io.BytesIO()
+    write_cx(decode_cx_compact(data), out)
+    assert out.getvalue() == data
@@ -0,0 +1,42 @@
+import random
+import pytest
+from util.delta import make_delta, apply_delta, block_size_for
+
+r = random.Random(0)
+BASE = r.randbytes(200_000)
+
+def round_trip(base, target, **kwargs):
+    delta = make_delta(base, target, **kwargs)
+    assert delta is not None
+    assert apply_delta(base, delta) == target
+    return delta
+
+@pytest.mark.parametrize('target', [
+    BASE,
+    BASE[:1000] + b'changed' + BASE[1007:],
+    BASE[:50_000] + r.randbytes(3000) + BASE[50_000:], # inserted
+    BASE[:50_000] + BASE[80_000:], # removed
+    BASE[100_000:] + BASE[:100_000], # moved
+    BASE[:-1],
+    BASE + b'x',
+])
+def test_round_trip(target):
+    round_trip(BASE, target)
+
+def test_identical_is_small():
+    # one copy of every whole block, and the bytes after the last one as they are
+    assert len(round_trip(BASE, BASE)) < block_size_for(len(BASE)) + 64
+
+@pytest.mark.parametrize('base, target', [(b'', b''), (b'', b'new'), (b'old', b''), (b'abc', b'abc'), (b'short', b'other')])
+def test_empty_and_tiny(base, target):
+    round_trip(base, target, max_literal=len(target))
+
+def test_unrelated_target_is_not_worth_a_delta():
+    assert make_delta(BASE, r.randbytes(len(BASE))) is None
+
+def test_wrong_base():
+    delta = round_trip(BASE, BASE[:-1])
+    with pytest.raises(ValueError):
+        apply_delta(BASE[:-1], delta)
+    with pytest.raises(ValueError):
+        apply_delta(BASE, b'not a delta at all......')
@@ -0,0 +1,30 @@
+import os
+from util.mod import detect_changes, registry_key, hash
+from util.registry import Registry
+
+def registered(directory):
+    # a registry of directory as dump would save it
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        st = os.stat(path)
+        entries.append((registry_key(path), st.st_size, st.st_mtime_ns, hash(path), None))
+    reg = Registry()
+    reg.update(entries)
+    return reg
+
+def test_edit_keeping_mtime_is_found(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('mod')
+    with open('mod/data.txt', 'wb') as f:
+        f.write(b'original')
+    reg = registered('mod')
+    st = os.stat('mod/data.txt')
+    with open('mod/data.txt', 'wb') as f:
+        f.write(b'modified') # same size
+    os.utime('mod/data.txt', ns=(st.st_atime_ns, st.st_mtime_ns))
+    _, new, modified, deleted = detect_changes('mod', reg, jobs=1)
+    assert modified == {'mod/data.txt'} and not new and not deleted
+    # the shortcut is only taken when asked for
+    _, _, modified, _ = detect_changes('mod', reg, jobs=1, trust_mtime=True)
+    assert modified == set()
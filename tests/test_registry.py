@@ -0,0 +1,31 @@
+import json
+import pytest
+from util.registry import Registry, load_registry
+
+OLD = {'a.cx': 'h1', 'b.cx': 'h2', 'c/d.snd': 'h3', 'gone.tex': 'h4', 'no hash': None}
+NEW = {'a.cx': 'h1', 'b.cx': 'changed', 'c/d.snd': 'h3', 'c/new.snd': 'h5', 'no hash': None, 'é.cx': 'h6'}
+EXPECTED = (['c/new.snd', 'é.cx'], ['b.cx'], ['gone.tex'])
+
+def save(path, files, kind):
+    if kind == 'json':
+        with open(path, 'w') as f:
+            json.dump(files, f)
+    else:
+        Registry.create(str(path), [(name, None, None, digest, None) for name, digest in files.items()]).close()
+    return str(path)
+
+@pytest.mark.parametrize('old_kind', ['json', 'sqlite'])
+@pytest.mark.parametrize('new_kind', ['json', 'sqlite'])
+def test_diff(tmp_path, old_kind, new_kind):
+    old_path = save(tmp_path / f'old.{old_kind}', OLD, old_kind)
+    new_path = save(tmp_path / f'new.{new_kind}', NEW, new_kind)
+    with load_registry(old_path) as old, load_registry(new_path) as new:
+        assert old.diff(new) == EXPECTED
+        assert old.diff(new) == EXPECTED # the other database is detached again afterwards
+        assert new.diff(old) == (EXPECTED[2], EXPECTED[1], EXPECTED[0])
+        assert old.diff(old) == ([], [], [])
+
+def test_diff_empty(tmp_path):
+    with Registry() as empty, load_registry(save(tmp_path / 'new.sqlite', NEW, 'sqlite')) as new:
+        assert empty.diff(new) == (sorted(NEW), [], [])
+        assert new.diff(empty) == ([], [], sorted(NEW))
@@ -0,0 +1,38 @@
+import json
+import os
+import zipfile
+import pytest
+from util.mod import unpackage
+
+def make_mod(path, files):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+        zf.writestr('packed.teareg', json.dumps({name: None for name in files}))
+        zf.writestr('mod.json', json.dumps({'id': 'test'}))
+
+def test_bad_member_keeps_original(tmp_path):
+    game = tmp_path / 'game'
+    game.mkdir()
+    (game / 'data.txt').write_bytes(b'original')
+    archive = tmp_path / 'test.teamod'
+    make_mod(archive, {'data.txt': b'replacement' * 100})
+    # break the member's data so its CRC doesn't match
+    raw = bytearray(archive.read_bytes())
+    start = raw.index(b'replacement')
+    raw[start:start + 11] = b'REPLACEMENT'
+    archive.write_bytes(bytes(raw))
+    with pytest.raises(zipfile.BadZipFile):
+        unpackage(str(archive), str(game), backup_dir=str(tmp_path / 'backup'))
+    assert (game / 'data.txt').read_bytes() == b'original'
+    assert os.listdir(game) == ['data.txt']
+
+def test_replaces_and_backs_up(tmp_path):
+    game = tmp_path / 'game'
+    game.mkdir()
+    (game / 'data.txt').write_bytes(b'original')
+    archive = tmp_path / 'test.teamod'
+    make_mod(archive, {'data.txt': b'replacement'})
+    unpackage(str(archive), str(game), backup_dir=str(tmp_path / 'backup'))
+    assert (game / 'data.txt').read_bytes() == b'replacement'
+    assert (tmp_path / 'backup' / 'data.txt').read_bytes() == b'original'
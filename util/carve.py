@@ -0,0 +1,155 @@
+import mmap
+import os
+import re
+import struct
+from contextlib import contextmanager
+
+# finds audio streams embedded in other files (.snd files are one or more streams behind a game-specific
+# header). one regex search finds the next candidate signature, the container is then walked to check it's
+# real and find where it ends, and the search carries on after it - so every file is read once, front to back.
+SIGNATURES = re.compile(rb'OggS\x00|ID3[\x02-\x04]|RIFF[\s\S]{4}WAVE|\xff[\xe0-\xff]')
+
+_OGG_PAGE = struct.Struct('<4sBBqIIIB')
+_UINT = struct.Struct('<I')
+_MPEG_HEADER = struct.Struct('>I')
+
+# kbps by (MPEG-1?, layer bits) - layer bits are 3 for layer I, 2 for layer II, 1 for layer III
+_BITRATES = {
+    (True, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# by version bits - 3 is MPEG-1, 2 is MPEG-2, 0 is MPEG-2.5
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+# the bits every frame of a stream has to agree on: sync, version, layer and sample rate
+_MPEG_STREAM_MASK = 0xfffe0c00
+# a run of bare MPEG frames shorter than this is more likely noise that happens to look like a header
+MIN_BARE_MPEG_FRAMES = 4
+
+def ogg_end(data, start):
+    # pages follow each other until the one flagged as the end of the stream
+    pos = start
+    n = len(data)
+    while pos + _OGG_PAGE.size <= n:
+        magic, version, flags, granule, serial, sequence, crc, segments = _OGG_PAGE.unpack_from(data, pos)
+        if magic != b'OggS' or version != 0:
+            break
+        table_end = pos + _OGG_PAGE.size + segments
+        if table_end > n:
+            break
+        page_end = table_end + sum(data[pos + _OGG_PAGE.size:table_end])
+        if page_end > n:
+            break
+        pos = page_end
+        if flags & 4:
+            break
+    return pos if pos > start else None
+
+def riff_end(data, start):
+    end = start + 8 + _UINT.unpack_from(data, start + 4)[0]
+    return end if end <= len(data) else None
+
+def mpeg_frame_length(header):
+    if header >> 21 != 0x7ff:
+        return None
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    bitrate_index = (header >> 12) & 15
+    rate_index = (header >> 10) & 3
+    padding = (header >> 9) & 1
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = _BITRATES[(version == 3, layer)][bitrate_index] * 1000
+    rate = _SAMPLE_RATES[version][rate_index]
+    if layer == 3:
+        return (12 * bitrate // rate + padding) * 4
+    if layer == 1 and version != 3:
+        return 72 * bitrate // rate + padding
+    return 144 * bitrate // rate + padding
+
+def mpeg_end(data, start, min_frames=1):
+    pos = start
+    n = len(data)
+    first = None
+    frames = 0
+    while pos + 4 <= n:
+        header = _MPEG_HEADER.unpack_from(data, pos)[0]
+        if first is not None and header & _MPEG_STREAM_MASK != first & _MPEG_STREAM_MASK:
+            break
+        length = mpeg_frame_length(header)
+        if length is None or pos + length > n:
+            break
+        if first is None:
+            first = header
+        pos += length
+        frames += 1
+    if frames < min_frames:
+        return None
+    if data[pos:pos + 3] == b'TAG' and pos + 128 <= n: # ID3v1 tag at the end
+        pos += 128
+    return pos
+
+def id3_end(data, start):
+    if start + 10 > len(data):
+        return None
+    flags = data[start + 5]
+    size = data[start + 6:start + 10]
+    if any(b & 0x80 for b in size):
+        return None
+    tag_end = start + 10 + (size[0] << 21 | size[1] << 14 | size[2] << 7 | size[3]) + (10 if flags & 0x10 else 0)
+    if tag_end > len(data):
+        return None
+    return mpeg_end(data, tag_end)
+
+def carve(data):
+    """
+    Returns (start, end, extension) for every audio stream found in data (bytes, mmap, memoryview...), in order.
+    """
+    streams = []
+    pos = 0
+    while True:
+        match = SIGNATURES.search(data, pos)
+        if match is None:
+            break
+        start = match.start()
+        kind = match.group()[:1]
+        if kind == b'O':
+            end, ext = ogg_end(data, start), 'ogg'
+        elif kind == b'I':
+            end, ext = id3_end(data, start), 'mp3'
+        elif kind == b'R':
+            end, ext = riff_end(data, start), 'wav'
+        else:
+            end, ext = mpeg_end(data, start, MIN_BARE_MPEG_FRAMES), 'mp3'
+        if end is None:
+            pos = start + 1
+            continue
+        streams.append((start, end, ext))
+        pos = end
+    return streams
+
+@contextmanager
+def mapped(path):
+    # the whole file as an mmap (or b'' for empty files, which can't be mapped), read front to back
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            yield data
+
+def write_streams(data, streams, paths):
+    # the streams go to disk straight from data, without copying them out of it first
+    with memoryview(data) as view:
+        for (start, end, _), path in zip(streams, paths):
+            with open(path, 'wb') as f:
+                f.write(view[start:end])
@@ -0,0 +1,150 @@
+import io
+import os
+import struct
+from array import array
+from itertools import accumulate
+from teacx import CompactCXFile, read_cx_header, read_cx_compact_path, cx_events, write_xml, write_json
+
+# decoded .cx files, stored under the SHA-256 of the .cx file: the pre-parsed tree (a CompactCXFile) and the XML
+# and JSON rendered from it, so an unchanged file never has to be decoded twice. entries never change once
+# written, so dump's workers can share the cache without any locking. an entry's modification time is when it
+# was last used, and the least recently used entries are evicted once the cache grows past its size limit.
+#
+# the digests in the CX header would save hashing the file, but they aren't safe to key on - patching a file
+# (teacx.py patch/apply) changes its nodes and leaves its header as it was
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# the compact format is the CompactCXFile arrays as they are in memory, so loading one is mostly array.frombytes():
+#   magic, header length, header (as in the .cx file)
+#   string count, utf-8 length, then the length of every string (in characters) and all of them as one utf-8 blob
+#   for each array in _ARRAYS: item count, then the items
+COMPACT_MAGIC = b'TEACXC01'
+_ARRAYS = ['parents', 'types', 'lines', 'contents', 'attr_starts', 'attr_names', 'attr_values', 'child_counts', 'ends']
+_COUNT = struct.Struct('<Q')
+
+def pack_compact(file):
+    header = file.header.serialise()
+    strings = file.strings.strings
+    blob = ''.join(strings).encode('utf-8')
+    out = [COMPACT_MAGIC, _COUNT.pack(len(header)), header, _COUNT.pack(len(strings)), _COUNT.pack(len(blob)), array('I', map(len, strings)).tobytes(), blob]
+    for name in _ARRAYS:
+        items = getattr(file, name)
+        out.append(_COUNT.pack(len(items)))
+        out.append(items.tobytes())
+    return b''.join(out)
+
+def unpack_compact(data):
+    if data[:len(COMPACT_MAGIC)] != COMPACT_MAGIC:
+        raise ValueError('Not a compact CX file')
+    view = memoryview(data)
+    pos = len(COMPACT_MAGIC)
+
+    def count():
+        nonlocal pos
+        value = _COUNT.unpack_from(view, pos)[0]
+        pos += _COUNT.size
+        return value
+
+    def take(size):
+        nonlocal pos
+        pos += size
+        return view[pos - size:pos]
+
+    file = CompactCXFile()
+    header_size = count()
+    file.header = read_cx_header(io.BytesIO(take(header_size)))
+    string_count = count()
+    blob_size = count()
+    lengths = array('I')
+    lengths.frombytes(take(string_count * lengths.itemsize))
+    text = str(take(blob_size), 'utf-8')
+    ends = list(accumulate(lengths))
+    strings = [text[end - length:end] for end, length in zip(ends, lengths)]
+    file.strings.strings = strings
+    file.strings.ids = {string: i for i, string in enumerate(strings)}
+    for name in _ARRAYS:
+        items = getattr(file, name)
+        items.frombytes(take(count() * items.itemsize))
+    return file
+
+class CXCache:
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.path.join(directory, f'v{CACHE_VERSION}')
+        self.max_size = max_size
+
+    def path(self, digest, kind):
+        return os.path.join(self.directory, digest[:2], digest + '.' + kind)
+
+    def lookup(self, digest, kind):
+        # the entry's path, or None if it isn't cached. touching it is what keeps it from being evicted
+        path = self.path(digest, kind)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, digest, kind, write, text=False):
+        # write(f) writes the entry. it goes to a temporary file first, so nobody ever sees half an entry
+        path = self.path(digest, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with (open(temp_path, 'w', encoding='utf-8', newline='') if text else open(temp_path, 'wb')) as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return path
+
+    def compact(self, digest, cx_path):
+        """Return the CompactCXFile for cx_path (whose SHA-256 is digest), decoding it only if it isn't cached."""
+        path = self.lookup(digest, 'compact')
+        if path is not None:
+            with open(path, 'rb') as f:
+                try:
+                    return unpack_compact(f.read())
+                except (ValueError, struct.error):
+                    pass # damaged, decoded again below
+        file = read_cx_compact_path(cx_path)
+        self.store(digest, 'compact', lambda f: f.write(pack_compact(file)))
+        return file
+
+    def render(self, digest, cx_path, use_json=False):
+        """Return the path of the cached XML (or JSON) for cx_path, rendering it from the pre-parsed tree if needed."""
+        kind = 'json' if use_json else 'xml'
+        path = self.lookup(digest, kind)
+        if path is not None:
+            return path
+        file = self.compact(digest, cx_path)
+        return self.store(digest, kind, lambda f: (write_json if use_json else write_xml)(cx_events(file), f), text=True)
+
+    def evict(self):
+        # removes the least recently used entries until the cache fits in max_size. returns how many were removed
+        if not os.path.isdir(self.directory):
+            return 0
+        entries = []
+        total = 0
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
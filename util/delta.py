@@ -0,0 +1,115 @@
+import struct
+from itertools import accumulate
+
+# rsync-style binary deltas: the base is cut into fixed-size blocks, and the target is scanned with a rolling
+# checksum so blocks are found again wherever they moved to. a delta is a header followed by copy (from the
+# base) and data (literal bytes) instructions:
+#   header: magic, base size, target size       '<8sQQ'
+#   copy:   b'C', base offset, length           '<cQI'
+#   data:   b'D', length, then the bytes        '<cI'
+DELTA_MAGIC = b'TEADELT1'
+_HEADER = struct.Struct('<8sQQ')
+_COPY = struct.Struct('<cQI')
+_DATA = struct.Struct('<cI')
+
+def block_size_for(size):
+    # about sqrt(size), like rsync - big enough to keep the block table small, small enough to find changes
+    block_size = 512
+    while block_size * block_size < size and block_size < 65536:
+        block_size *= 2
+    return block_size
+
+def checksum(block):
+    # the two 16-bit halves of the rolling checksum: the sum of the bytes, and the sum of those sums
+    return sum(block) & 0xffff, sum(accumulate(block)) & 0xffff
+
+def make_delta(base, target, block_size=None, max_literal=None):
+    """
+    Returns a delta that turns base into target, or None if it would have to carry more than max_literal bytes of
+    target as-is (default: half of it) - at that point shipping the whole file is about as good.
+    """
+    if block_size is None:
+        block_size = block_size_for(len(base))
+    if max_literal is None:
+        max_literal = len(target) // 2
+    blocks = {}
+    for offset in range(0, len(base) - block_size + 1, block_size):
+        a, b = checksum(base[offset:offset + block_size])
+        blocks.setdefault(a | b << 16, []).append(offset)
+    out = [_HEADER.pack(DELTA_MAGIC, len(base), len(target))]
+    copy = None # (offset, length) of the copy being built, so neighbouring blocks become one instruction
+    literal = 0
+    start = 0 # where the bytes not covered by a copy yet start
+    i = 0
+    n = len(target)
+    if blocks and n >= block_size:
+        a, b = checksum(target[:block_size])
+        while True:
+            match = None
+            for offset in blocks.get(a | b << 16, ()):
+                # the base is right here, so comparing the bytes is cheaper than a strong hash
+                if base[offset:offset + block_size] == target[i:i + block_size]:
+                    match = offset
+                    break
+            if match is not None:
+                if start < i:
+                    if copy is not None:
+                        out.append(_COPY.pack(b'C', *copy))
+                        copy = None
+                    out.append(_DATA.pack(b'D', i - start))
+                    out.append(target[start:i])
+                    literal += i - start
+                if copy is not None and copy[0] + copy[1] == match:
+                    copy = (copy[0], copy[1] + block_size)
+                else:
+                    if copy is not None:
+                        out.append(_COPY.pack(b'C', *copy))
+                    copy = (match, block_size)
+                i += block_size
+                start = i
+                if i + block_size > n:
+                    break
+                a, b = checksum(target[i:i + block_size])
+                continue
+            if i + block_size >= n:
+                break
+            old, new = target[i], target[i + block_size]
+            a = (a - old + new) & 0xffff
+            b = (b - block_size * old + a) & 0xffff
+            i += 1
+            if literal + i - start > max_literal:
+                return None
+    if copy is not None:
+        out.append(_COPY.pack(b'C', *copy))
+    if start < n:
+        literal += n - start
+        if literal > max_literal:
+            return None
+        out.append(_DATA.pack(b'D', n - start))
+        out.append(target[start:])
+    return b''.join(out)
+
+def apply_delta(base, delta):
+    """Rebuilds the target from base and a delta made by make_delta()."""
+    magic, base_size, target_size = _HEADER.unpack_from(delta, 0)
+    if magic != DELTA_MAGIC:
+        raise ValueError('Not a delta')
+    if len(base) != base_size:
+        raise ValueError(f'Delta is for a {base_size} byte file, got {len(base)} bytes')
+    out = []
+    pos = _HEADER.size
+    view = memoryview(delta)
+    while pos < len(delta):
+        if view[pos:pos + 1] == b'C':
+            _, offset, length = _COPY.unpack_from(delta, pos)
+            out.append(base[offset:offset + length])
+            pos += _COPY.size
+        else:
+            _, length = _DATA.unpack_from(delta, pos)
+            pos += _DATA.size
+            out.append(delta[pos:pos + length])
+            pos += length
+    target = b''.join(out)
+    if len(target) != target_size:
+        raise ValueError(f'Delta produced {len(target)} bytes, expected {target_size}')
+    return target
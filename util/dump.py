@@ -1,51 +1,22 @@
 import colorama
+import errno
 import os
-from typing import Tuple
+import shutil
 import traceback
-from teacx import read_cx, cx_to_xml, cx_to_json, format_leading_to_gamedir
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from teacx import iterparse_cx, write_xml, write_json, format_leading_to_gamedir, EVENT_NAMES, read_cx_header_path, header_to_json
 import hashlib
 import json
+import time
+from util.metrics import metrics, log, Progress
 from util.mod import init
+from util.parallel import ordered_map
+from util.registry import Registry
+from util.carve import carve, mapped, write_streams
+from util.cxcache import CXCache, DEFAULT_MAX_SIZE
 
-supported_formats = ['ogg', 'mp3', 'tga', 'bmp', 'wav', 'xml', 'cx']
-
-def process_snd_file(f) -> Tuple[bytes, str]:
-    # custom sound file format - it's actually an OGG but with a bunch of junk at the start
-    data = data[data.find(b'OggS'):]
-    if len(data) > 30:
-        return data, 'ogg'
-    # try looking for ID3 tags
-    data = data[data.find(b'ID3'):]
-    if len(data) > 30:
-        return data, 'mp3'
-    # jesus christ - wav??
-    data = data[data.find(b'Info'):]
-    if len(data) > 30:
-        return data, 'wav'
-    data = data[data.find(b'RIFF'):]
-    if len(data) > 30:
-        return data, 'wav'
-    return None, None
-    
-def process_other_file(f, path, use_json=False) -> Tuple[bytes, str]:
-    if path.endswith('.cx'):
-        f.seek(0)
-        file = read_cx(f)
-        if not use_json:
-            return cx_to_xml(file).encode('utf-8'), 'xml'
-        else:
-            return cx_to_json(file).encode('utf-8'), 'json'
-    if os.path.getsize(path) >= 18:
-        f.seek(-18, os.SEEK_END)
-        if f.read() == b'TRUEVISION-XFILE.\x00' and not path.endswith('.tga'):
-            f.seek(0)
-            data = f.read()
-            return data, 'tga'
-    f.seek(0)
-    if f.read(2) == b'BM' and not path.endswith('.bmp'):
-        f.seek(0)
-        data = f.read()
-        return data, 'bmp'
+supported_formats = {'ogg', 'mp3', 'tga', 'bmp', 'wav', 'xml', 'json'}
 
 def err(msg):
     print(colorama.Fore.RED + msg + colorama.Style.RESET_ALL)
@@ -53,87 +24,305 @@ def err(msg):
 def warn(msg):
     print(colorama.Fore.YELLOW + msg + colorama.Style.RESET_ALL)
 
-def process_file(root, file, log_failed=False, use_json=False) -> Tuple[bytes, str]:
+# format detectors, tried in order. each says how many bytes from the start (head) and end (tail) of a file it
+# needs to look at, so a file is only read at both ends once no matter how many formats there are. detect(path,
+# head, tail, use_json) returns the extension to write the file with, or None - head and tail are the most any
+# detector asked for, so shorter for small files. write(path, newpath, use_json) writes the output
+Format = namedtuple('Format', ['name', 'detect', 'head', 'tail', 'write'])
+formats = []
+
+def register_format(name, head=0, tail=0, write=None):
+    def register(detect):
+        formats.append(Format(name, detect, head, tail, write or copy_file))
+        return detect
+    return register
+
+def detect_format(path, use_json=False):
+    # returns the Format the file is in (or None) and the extension to write it with
+    if os.path.splitext(path)[1][1:] in supported_formats:
+        return None, None
+    head_size = max(f.head for f in formats)
+    tail_size = max(f.tail for f in formats)
+    head = tail = b''
+    if head_size or tail_size:
+        with open(path, 'rb') as f:
+            head = f.read(head_size)
+            if tail_size:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - tail_size))
+                tail = f.read()
+    for fmt in formats:
+        ext = fmt.detect(path, head, tail, use_json)
+        if ext is not None:
+            return fmt, ext
+    return None, None
+
+def copy_file(path, newpath, use_json=False):
+    # formats that only get renamed are copied by the kernel, so they never pass through python whatever their size
+    if hasattr(os, 'copy_file_range'):
+        with open(path, 'rb') as src, open(newpath, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                # not supported between these filesystems
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+    shutil.copyfile(path, newpath) # uses sendfile() where there is one
+
+def write_decoded_cx(path, newpath, use_json=False):
+    # streamed straight to the output - the decoded file is never held in memory as a whole
+    with open(path, 'rb') as f, open(newpath, 'w', encoding='utf-8', newline='') as out:
+        events = iterparse_cx(f, events=EVENT_NAMES)
+        if use_json:
+            write_json(events, out)
+        else:
+            write_xml(events, out)
+
+@register_format('cx', write=write_decoded_cx)
+def detect_cx(path, head, tail, use_json):
+    if path.endswith('.cx'):
+        return 'json' if use_json else 'xml'
+
+@register_format('tga', tail=18)
+def detect_tga(path, head, tail, use_json):
+    if tail.endswith(b'TRUEVISION-XFILE.\x00'):
+        return 'tga'
+
+@register_format('bmp', head=2)
+def detect_bmp(path, head, tail, use_json):
+    if head.startswith(b'BM'):
+        return 'bmp'
+
+def write_file(dir, path, output, overwrite, skip_existing, use_json=False, log_failed=False, digest=None, cx_cache=None):
+    # decodes (or copies) one file into output. returns the output written (if any) and, if it already exists and
+    # mustn't be touched, its path. with a CXCache and the file's digest, .cx files are decoded through the cache
+    newpath = None
     try:
-        if file.split('.')[-1] in supported_formats:
+        fmt, ext = detect_format(path, use_json)
+        if fmt is None:
             return None, None
-        filepath = os.path.join(root, file)
-        filepath_noext = os.path.splitext(filepath)[0]
-        if filepath.endswith('.snd'):
-            with open(filepath, 'rb') as f:
-                data, ext = process_snd_file(f)
-                if data is not None:
-                    return data, filepath_noext + '.' + ext
-                else:
-                    warn(f'{filepath}: could not process sound file')
-                    return None, None
-        with open(filepath, 'rb') as f:
-            data, ext = process_other_file(f, filepath, use_json=use_json)
-            if data is not None:
-                return data, filepath_noext + '.' + ext
-            else:
-                warn(f'{filepath}: could not process file')
+        newpath = os.path.join(output, os.path.relpath(os.path.splitext(path)[0], dir)) + '.' + ext
+        if os.path.exists(newpath) and not overwrite:
+            if skip_existing:
                 return None, None
+            return None, newpath
+        os.makedirs(os.path.dirname(newpath), exist_ok=True)
+        # written next to it first, so a file that fails to decode doesn't leave half an output behind
+        if fmt.name == 'cx' and cx_cache is not None and digest is not None:
+            # copied rather than linked, the output is there to be edited
+            copy_file(cx_cache.render(digest, path, use_json), newpath + '.tmp')
+        else:
+            fmt.write(path, newpath + '.tmp', use_json)
+        os.replace(newpath + '.tmp', newpath)
+        return newpath, None
     except Exception as e:
         if log_failed:
-            err(f'Error processing {filepath}: {e}')
+            err(f'Error processing {path}: {e}')
             traceback.print_exc()
+        else:
+            warn(f'{path}: could not process file')
+        if newpath is not None and os.path.exists(newpath + '.tmp'):
+            os.remove(newpath + '.tmp')
         return None, None
 
+def snd_output_paths(base, streams):
+    # the first stream keeps the plain name, any others are numbered after it
+    return [f'{base}.{ext}' if i == 0 else f'{base}.{i}.{ext}' for i, (start, end, ext) in enumerate(streams)]
+
+def dump_snd_file(dir, path, output, overwrite, skip_existing):
+    # like dump_file(), but every stream in the file is written out, straight from one mapping of it that's
+    # also used for the hash
+    with mapped(path) as data:
+        digest = hashlib.sha256(data).hexdigest()
+        streams = carve(data)
+        if not streams:
+            warn(f'{path}: could not process sound file')
+            return digest, None, None
+        base = os.path.join(output, os.path.relpath(os.path.splitext(path)[0], dir))
+        paths = snd_output_paths(base, streams)
+        if not overwrite:
+            for newpath in paths:
+                if os.path.exists(newpath):
+                    if skip_existing:
+                        return digest, None, None
+                    return digest, None, newpath
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        write_streams(data, streams, paths)
+    return digest, paths[0], None
+    
 def hash(file):
     h = hashlib.sha256()
     with open(file, 'rb') as file:
         chunk = 0
         while chunk != b'':
-            chunk = file.read(1024)
+            chunk = file.read(1024 * 1024)
             h.update(chunk)
     return h.hexdigest()
 
-def dump(dir, output=None, overwrite=False, skip_existing=False, reg_path=None, mod=False, use_json=False):
+# the dump cache remembers, for each file, the (size, mtime, inode) it had when it was last dumped along with
+# its hash and decoded output, so an incremental dump only has to look at files that changed since
+DUMP_CACHE_VERSION = 1
+
+def cache_path_for(reg_path):
+    return os.path.splitext(reg_path)[0] + '.teacache'
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+def load_dump_cache(cache_path, output, use_json):
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    # outputs from a dump with different settings can't be reused
+    if cache.get('version') != DUMP_CACHE_VERSION or cache.get('output') != output or cache.get('use_json') != use_json:
+        return {}
+    return cache['files']
+
+def save_dump_cache(cache_path, output, use_json, files):
+    with open(cache_path, 'w') as f:
+        json.dump({'version': DUMP_CACHE_VERSION, 'output': output, 'use_json': use_json, 'files': files}, f)
+
+def dump_file(dir, root, file, output, overwrite, skip_existing, testbuild, use_json, cx_cache=None):
+    # runs in a worker - hashes and decodes one file and writes its output, so only small results travel back.
+    # returns the file's hash, the output written (if any), if its output already exists and mustn't be touched
+    # that output's path, and the seconds spent hashing and decoding it. cx_cache is (directory, max size) or None
+    path = os.path.join(root, file)
+    start = time.perf_counter()
+    if file.endswith('.snd'):
+        digest, newpath, conflict = dump_snd_file(dir, path, output, overwrite, skip_existing or testbuild)
+        return digest, newpath, conflict, 0.0, time.perf_counter() - start # hashed along the way
+    digest = hash(path)
+    hashed = time.perf_counter()
+    cache = CXCache(*cx_cache) if cx_cache is not None else None
+    newpath, conflict = write_file(dir, path, output, overwrite, skip_existing or testbuild, use_json, digest=digest, cx_cache=cache)
+    return digest, newpath, conflict, hashed - start, time.perf_counter() - hashed
+
+def dump(dir, output=None, overwrite=False, skip_existing=False, reg_path=None, mod=False, use_json=False, jobs=None, incremental=False, json_registry=False, cx_cache=None, cx_cache_size=DEFAULT_MAX_SIZE):
     if not os.path.isdir(dir):
         err(f'Error: {dir} is not a directory')
         return
     testbuild = False
     if os.path.exists(os.path.join(dir, '_devConfig.xml')):
-        print("This appears to be a test build. CX decoding will be skipped.")
+        log("This appears to be a test build. CX decoding will be skipped.")
         testbuild = True
-    print(f'Dumping {dir}')
-    reg = {}
-    for root, dirs, files in os.walk(dir):
-        for file in files:
-            print(f'Processing {file}')
-            reg[format_leading_to_gamedir(os.path.join(root, file))] = hash(os.path.join(root, file))
-            data, newpath = process_file(root, file, use_json=use_json)
-            if data is None:
-                continue
-            if output is None:
-                output = dir
-            if not os.path.isdir(output):
-                os.makedirs(output)
-            newpath = os.path.join(output, newpath)
-            if os.path.exists(newpath) and not overwrite:
-                if skip_existing or testbuild:
-                    continue
-                err(f'Error: {newpath} already exists')
-                exit(1)
-            with open(newpath, 'wb') as f:
-                f.write(data)
+    log(f'Dumping {dir}')
+    if output is None:
+        output = dir
     if reg_path is None:
         reg_path = os.path.join(dir, 'dump.teareg')
-    with open(reg_path, 'w') as f:
-        json.dump(reg, f)
+    cache_path = cache_path_for(reg_path)
+    cache = load_dump_cache(cache_path, output, use_json) if incremental else {}
+    new_cache = {}
+    files = []
+    with metrics.stage('walk'):
+        for root, dirs, names in os.walk(dir):
+            for file in names:
+                path = os.path.join(root, file)
+                if os.path.abspath(path) == os.path.abspath(cache_path):
+                    continue
+                key = format_leading_to_gamedir(path)
+                signature = file_signature(path)
+                cached = cache.get(key)
+                if cached is not None and cached[:3] == signature and (cached[4] is None or os.path.exists(cached[4])):
+                    files.append((root, file, key, cached)) # unchanged since the last dump, nothing to do
+                else:
+                    files.append((root, file, key, signature))
+    reg = {}
+    rows = []
+    # an output recorded in the cache was written by an earlier dump, so it's ours to replace
+    cx_cache = (cx_cache, cx_cache_size) if cx_cache is not None else None
+    tasks = ((dir, root, file, output, overwrite or key in cache, skip_existing, testbuild, use_json, cx_cache) for root, file, key, entry in files if len(entry) == 3)
+    results = ordered_map(dump_file, tasks, jobs)
+    # results come back in walk order, so the registry is the same no matter how many jobs are used
+    skipped = 0
+    progress = Progress('Processing', len(files))
+    for root, file, key, entry in files:
+        progress.update(file)
+        if len(entry) == 3:
+            digest, newpath, conflict, hash_time, decode_time = next(results)
+            metrics.add('hash', hash_time)
+            metrics.add('decode', decode_time)
+            metrics.file('dump', key, entry[0], hash_time + decode_time)
+            if conflict is not None:
+                progress.close()
+                err(f'Error: {conflict} already exists')
+                exit(1)
+            entry = entry + [digest, newpath]
+        else:
+            skipped += 1
+        reg[key] = entry[3]
+        rows.append((key, entry[0], entry[1], entry[3], None if entry[4] is None else os.path.splitext(entry[4])[1][1:]))
+        new_cache[key] = entry
+    progress.close()
+    if incremental:
+        log(f'{skipped} unchanged files skipped')
+    with metrics.stage('registry'):
+        if json_registry:
+            with open(reg_path, 'w') as f:
+                json.dump(reg, f)
+        else:
+            Registry.create(reg_path, rows).close()
+        save_dump_cache(cache_path, output, use_json, new_cache)
+    if cx_cache is not None:
+        with metrics.stage('evict'):
+            evicted = CXCache(*cx_cache).evict()
+        if evicted:
+            log(f'{evicted} old entries removed from the CX cache')
     if mod:
         init(dir)
-    print(colorama.Fore.BLUE + 'Done!' + colorama.Style.RESET_ALL)
+    log(colorama.Fore.BLUE + 'Done!' + colorama.Style.RESET_ALL)
 
-def decode(file, use_json=False):
+def decode(file, use_json=False, cx_cache=None, cx_cache_size=DEFAULT_MAX_SIZE):
     if not os.path.isfile(file):
         err(f'Error: {file} is not a file')
         return
-    print(f'Decoding {file}')
-    with open(file, 'rb') as f:
-        data, newpath = process_file(os.path.dirname(file), os.path.basename(file), log_failed=True, use_json=use_json)
-        if data is None:
-            return
-        with open(newpath, 'wb') as f2:
-            f2.write(data)
\ No newline at end of file
+    log(f'Decoding {file}')
+    if file.endswith('.snd'):
+        dump_snd_file(os.path.dirname(file) or '.', file, os.path.dirname(file) or '.', True, False)
+        return
+    cache = None
+    digest = None
+    if cx_cache is not None and file.endswith('.cx'):
+        cache = CXCache(cx_cache, cx_cache_size)
+        digest = hash(file)
+    write_file(os.path.dirname(file) or '.', file, os.path.dirname(file) or '.', True, False, use_json, log_failed=True, digest=digest, cx_cache=cache)
+    if cache is not None:
+        cache.evict()
+
+def read_header(path):
+    try:
+        return header_to_json(read_cx_header_path(path))
+    except Exception as e:
+        warn(f'{path}: could not read header ({e})')
+        return None
+
+def inventory(dir, output=None, jobs=None):
+    if not os.path.isdir(dir):
+        err(f'Error: {dir} is not a directory')
+        return
+    paths = sorted(os.path.join(root, file) for root, dirs, files in os.walk(dir) for file in files if file.endswith('.cx'))
+    # only the first few hundred bytes of each file are read, so this is all waiting on the disk - threads are enough
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        headers = list(pool.map(read_header, paths))
+    inv = {}
+    for path, header in zip(paths, headers):
+        if header is not None:
+            inv[format_leading_to_gamedir(path)] = header
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(inv, f, indent=4)
+        print(colorama.Fore.BLUE + f'Wrote {len(inv)} headers to {output}' + colorama.Style.RESET_ALL)
+        return
+    width = max([len(path) for path in inv] + [4])
+    print(f'{"path":<{width}}  version  build  digested source                   digested definition')
+    for path, header in inv.items():
+        digests = header['serialisable_resource_header']
+        print(f'{path:<{width}}  {header["cx_version"]:<7}  {header["build_number"]:<5}  {digests["digested_source"]}  {digests["digested_definition"]}')
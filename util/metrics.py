@@ -0,0 +1,99 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+# where the time goes in a run. stages are timed in this process (wall and CPU time) - work done by worker
+# processes is added to its stage as the workers' wall time, so the stages of a parallel run add up to more than
+# the run itself. files records what each file cost, to find the slowest ones on a real install
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = {}
+        self.files = []
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add(self, name, wall, cpu=0.0):
+        stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'count': 0})
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['count'] += 1
+
+    def file(self, stage, path, size, seconds):
+        self.files.append((stage, path, size, seconds))
+
+    def report(self, slowest=20):
+        files = [{'stage': stage, 'path': path, 'size': size, 'seconds': round(seconds, 6)} for stage, path, size, seconds in self.files]
+        return {
+            'wall': round(time.perf_counter() - self.start_wall, 6),
+            'cpu': round(time.process_time() - self.start_cpu, 6),
+            'stages': {name: {key: round(value, 6) for key, value in stage.items()} for name, stage in self.stages.items()},
+            'slowest_files': sorted(files, key=lambda f: f['seconds'], reverse=True)[:slowest],
+            'files': files,
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+metrics = Metrics()
+
+quiet = False
+
+def set_quiet(value):
+    global quiet
+    quiet = value
+
+def log(msg):
+    # for progress messages - errors and warnings are printed even when quiet
+    if not quiet:
+        print(msg)
+
+class Progress:
+    """
+    A count of processed files, shown as one line that's rewritten at most every interval seconds (or printed
+    again every few seconds when the output isn't a terminal), instead of a line per file.
+    """
+    def __init__(self, label, total=None, interval=0.2):
+        self.label = label
+        self.total = total
+        self.count = 0
+        self.tty = sys.stdout.isatty()
+        self.interval = interval if self.tty else 5.0
+        self.last = time.monotonic()
+        self.width = 0
+
+    def update(self, detail='', n=1):
+        self.count += n
+        now = time.monotonic()
+        if quiet or now - self.last < self.interval:
+            return
+        self.last = now
+        self.show(detail)
+
+    def show(self, detail=''):
+        text = f'{self.label}: {self.count}' + (f'/{self.total}' if self.total is not None else '') + (f' {detail}' if detail else '')
+        if self.tty:
+            text = text[:119]
+            print('\r' + text.ljust(self.width), end='', flush=True)
+            self.width = len(text)
+        else:
+            print(text, flush=True)
+
+    def close(self):
+        if quiet or self.count == 0:
+            return
+        self.show()
+        if self.tty:
+            print()
@@ -3,9 +3,22 @@ import os
 import json
 import shutil
 import hashlib
-from teacx import format_leading_to_gamedir, xml_to_cx, json_to_cx
+from teacx import format_leading_to_gamedir, strip_leading_to_gamedir, xml_events, json_events, events_to_cx, write_cx, decode_cx, read_cx_path, diff_cx, apply_cx_diff, diffs_conflict
 from typing import Tuple
 import subprocess
+from itertools import combinations
+import time
+import zipfile
+import zlib
+import sys
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+from util.registry import load_registry
+from util.parallel import ordered_map
+from util.delta import make_delta, apply_delta
+from util.metrics import metrics, log, Progress
 
 def hash(file):
     try:
@@ -13,7 +26,7 @@ def hash(file):
         with open(file, 'rb') as file:
             chunk = 0
             while chunk != b'':
-                chunk = file.read(1024)
+                chunk = file.read(1024 * 1024)
                 h.update(chunk)
         return h.hexdigest()
     except FileNotFoundError:
@@ -37,43 +50,144 @@ def init(dir):
     with open(os.path.join(dir, mod_config['id'] + '.mod.json'), 'w') as f:
         json.dump(mod_config, f)
 
-def package(directory: str, reg_path=None, config_path=None, output_path=None, pause_before_zip=False):
-    print(f'Packaging {directory}...')
+def is_metadata(file):
+    # registries, caches and mod configs live in the mod directory but are never part of the mod itself
+    name = os.path.basename(file)
+    return name in ('dump.teareg', 'packed.teareg', 'dump.teacache') or name.endswith('mod.json')
+
+def stat_and_hash(path, known, trust_mtime=False):
+    # runs in a thread. with trust_mtime, a file whose size and mtime still match the registry keeps its registered
+    # hash without being read - faster, but edits that keep the mtime (cp -p, unzip...) go unnoticed
+    if trust_mtime and known is not None:
+        st = os.stat(path)
+        if known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+    return hash(path)
+
+def registry_key(path):
+    # the key a file in the mod directory has in the registry
+    return format_leading_to_gamedir(path[1:] if path.startswith('/') or path.startswith('\\') else path)
+
+def detect_changes(directory, old_reg, jobs=None, trust_mtime=False):
+    # walks the directory once and hashes every file at most once. returns {key: (path, hash)} for every
+    # file along with the sets of new, modified and deleted keys compared to the registry
+    known = old_reg.entries()
+    files = []
+    for root, dirs, names in os.walk(directory):
+        for file in names:
+            path = os.path.join(root, file)
+            files.append((registry_key(path), path))
+    # hashlib releases the GIL, so threads are enough to keep the disk busy
+    results = ordered_map(stat_and_hash, ((path, known.get(key), trust_mtime) for key, path in files), jobs, threads=True)
+    digests = {}
+    new = set()
+    modified = set()
+    progress = Progress('Hashing', len(files))
+    for (key, path), digest in zip(files, results):
+        progress.update(path)
+        digests[key] = (path, digest)
+        if key not in known:
+            new.add(key)
+        elif known[key][2] != digest:
+            modified.add(key)
+    progress.close()
+    deleted = set(known) - set(digests)
+    return digests, new, modified, deleted
+
+# these are compressed already, deflating them again only costs time
+stored_exts = ["ogg", "mp3", "snd"]
+# members up to this size are deflated by worker threads, bigger ones are streamed into the archive by zipfile
+parallel_deflate_limit = 16 * 1024 * 1024
+# how many bytes of members the threads can have read (and not yet written) at once
+parallel_deflate_memory = 128 * 1024 * 1024
+
+def is_stored(arcname):
+    return arcname.lower().rsplit('.', 1)[-1] in stored_exts
+
+# the Python versions whose zipfile write_compressed_member is known to work with (tests/test_archive.py checks the
+# archives it writes). it relies on zipfile's private bookkeeping, so on any other version members are deflated by
+# zipfile itself instead
+compressed_member_versions = ((3, 8), (3, 14))
+
+def can_write_compressed():
+    return compressed_member_versions[0] <= sys.version_info[:2] <= compressed_member_versions[1]
+
+def deflated_size(path, arcname):
+    # how much of a member compress_member holds in memory
+    if is_stored(arcname):
+        return 0
+    size = os.path.getsize(path)
+    return size if size <= parallel_deflate_limit else 0
+
+def compress_member(path, arcname):
+    # runs in a thread - zlib releases the GIL, so independent members deflate in parallel. returns the member's
+    # info, its deflated data (None if zipfile should write it itself) and the seconds it took
+    start = time.perf_counter()
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    if is_stored(arcname) or zinfo.file_size > parallel_deflate_limit:
+        return zinfo, None, 0.0
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed)
+    zinfo.CRC = zlib.crc32(data)
+    return zinfo, compressed, time.perf_counter() - start
+
+def write_compressed_member(zf, zinfo, data):
+    # zipfile has no way to add data that's already deflated, so this lays the member out the same way
+    # ZipFile.open(zinfo, 'w') does - except the sizes and CRC are known up front, so the header is final.
+    # only called where can_write_compressed() says zipfile still works this way
+    with zf._lock:
+        zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(False))
+        zf.fp.write(data)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+
+def cx_patch(path, new_file, original_hash):
+    # the changes from the game's own copy of a CX file (if path still is that copy) to new_file and the hash the
+    # file has once they're applied, or None if the whole file has to be packaged - because the original is gone,
+    # or because the patch wouldn't be any smaller
+    if original_hash is None or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        original = f.read()
+    if hashlib.sha256(original).hexdigest() != original_hash:
+        return None
+    base = decode_cx(original)
+    ops = diff_cx(base, new_file)
+    if len(json.dumps(ops)) >= len(original):
+        return None
+    # the installer compares files against this to tell whether the patch is already applied. the ops don't
+    # refer to base's nodes, so base itself can be patched now that the diff is done
+    apply_cx_diff(base, ops)
+    return ops, hashlib.sha256(base.serialise()).hexdigest()
+
+def file_delta(base_path, path, base_hash):
+    # runs in a worker - a delta from the game's copy of a file (if it's the one the registry knows) to the mod's,
+    # or None if the whole file has to be packaged
+    if base_hash is None or not os.path.isfile(base_path):
+        return None
+    with open(base_path, 'rb') as f:
+        base = f.read()
+    if hashlib.sha256(base).hexdigest() != base_hash:
+        return None
+    with open(path, 'rb') as f:
+        return make_delta(base, f.read())
+
+def package(directory: str, reg_path=None, config_path=None, output_path=None, pause_before_zip=False, jobs=None, cx_patches=True, delta_base=None, trust_mtime=False):
+    log(f'Packaging {directory}...')
     testbuild = False
     if os.path.exists(os.path.join(directory, '_devConfig.xml')):
-        print("This appears to be a test build. CX reserialisation will be skipped.")
+        log("This appears to be a test build. CX reserialisation will be skipped.")
         testbuild = True
-    if not testbuild:
-        print("Reserialising CX files...")
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.endswith('.cx'):
-                    print(f'Reserialising {root}/{file}')
-                    for file2 in files:
-                        if file2 == file.replace('.cx', '.xml'):
-                            cxfile = xml_to_cx(os.path.join(root, file2))
-                            break
-                        if file2 == file.replace('.cx', '.json'):
-                            cxfile = json_to_cx(os.path.join(root, file2))
-                            break
-                    try:
-                        cxfile
-                    except NameError:
-                        warn(f'Warning: {root}/{file} has no corresponding .xml or .json file')
-                        continue
-                    with open(os.path.join(root, file), 'wb') as f:
-                        f.write(cxfile.serialise())
-    warn("WARNING: You should reserialise all files other than .cx files before packaging by hand. This tool will not do it for you.\n\
-          For instance - all .wav files should be reserialised to .snd files, or should be placed in the _source folder for the game to correctly load them.")
-    print("Cleaning up...")
-    shutil.rmtree('temp', ignore_errors=True)
-    new_reg = {}
-    deleted = []
-    new = []
-    modified = []
-    if reg_path is None:
-        reg_path = os.path.join(directory, 'dump.teareg')
-    old_reg = json.load(open(reg_path))
     if config_path is None:
         config_path = [f for f in os.listdir(directory) if f.endswith('.mod.json')]
         if len(config_path) == 0:
@@ -84,135 +198,617 @@ def package(directory: str, reg_path=None, config_path=None, output_path=None, p
             return
         config_path = os.path.join(directory, config_path[0])
     config = json.load(open(config_path))
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            print(f'Processing {root}/{file}')
-            file = os.path.join(root, file)
-            if file.startswith('/') or file.startswith('\\'):
-                file = file[1:]
-            if format_leading_to_gamedir(file) in old_reg:
-                if old_reg[format_leading_to_gamedir(file)] != hash(file):
-                    modified.append(format_leading_to_gamedir(file))
-            else:
-                new.append(format_leading_to_gamedir(file))
-            new_reg[file] = hash(file)
+    if reg_path is None:
+        reg_path = os.path.join(directory, 'dump.teareg')
+    old_reg = load_registry(reg_path)
+    patches = {}
+    patched_sources = set() # the .xml/.json files of CX files sent as patches - the patch is all the game needs
+    if not testbuild:
+        log("Reserialising CX files...")
+        progress = Progress('Reserialising')
+        with metrics.stage('reserialise'):
+            for root, dirs, files in os.walk(directory):
+                names = set(files)
+                for file in files:
+                    if file.endswith('.cx'):
+                        progress.update(f'{root}/{file}')
+                        start = time.perf_counter()
+                        events = None
+                        if file.replace('.cx', '.xml') in names:
+                            source_path = os.path.join(root, file.replace('.cx', '.xml'))
+                            with open(source_path, 'r') as f:
+                                original_path = strip_leading_to_gamedir(os.path.relpath(source_path, directory))
+                                events = xml_events(f.read(), original_path=original_path)
+                        elif file.replace('.cx', '.json') in names:
+                            source_path = os.path.join(root, file.replace('.cx', '.json'))
+                            with open(source_path, 'r') as f:
+                                events = json_events(json.load(f))
+                        if events is None:
+                            warn(f'Warning: {root}/{file} has no corresponding .xml or .json file')
+                            continue
+                        cx_path = os.path.join(root, file)
+                        new_file = events_to_cx(events)
+                        key = registry_key(cx_path)
+                        patch = cx_patch(cx_path, new_file, old_reg.get(key)) if cx_patches else None
+                        if patch is not None:
+                            # the game's copy is left alone, so it isn't packaged and can be diffed again next time
+                            ops, patched_hash = patch
+                            if len(ops) > 0:
+                                patches[key] = {'base': old_reg[key], 'hash': patched_hash, 'ops': ops}
+                            patched_sources.add(registry_key(source_path))
+                            metrics.file('reserialise', key, os.path.getsize(cx_path), time.perf_counter() - start)
+                            continue
+                        with open(cx_path, 'wb') as f:
+                            write_cx(new_file, f)
+                        metrics.file('reserialise', key, os.path.getsize(cx_path), time.perf_counter() - start)
+        progress.close()
+    warn("WARNING: You should reserialise all files other than .cx files before packaging by hand. This tool will not do it for you.\n\
+          For instance - all .wav files should be reserialised to .snd files, or should be placed in the _source folder for the game to correctly load them.")
+    with metrics.stage('hash'):
+        digests, new, modified, deleted = detect_changes(directory, old_reg, jobs, trust_mtime)
+    base_hashes = {file: old_reg.get(file) for file in modified}
+    old_reg.close()
+    log(f'{len(new)} new, {len(modified)} modified, {len(deleted)} deleted files, {len(patches)} CX files patched')
+    if len(deleted) > 0:
+        warn('Warning: deleted files can\'t be packaged and will be left in place by the mod')
     final_reg = {}
-    ignored = ["/dump.teareg", "/packed.teareg"]
-    for file in old_reg:
-        if file in new or file in modified and file not in ignored and not "mod.json" in file:
-            final_reg[file] = old_reg[file]
-    for file in (new + modified):
-        if file in ignored:
-            continue
-        real_file = os.path.join(directory, file[1:] if file.startswith('/') else file)
-        final_reg[file] = hash(real_file)
-    with open("packed.teareg", 'w') as f:
-        json.dump(final_reg, f)
+    for file in sorted(new | modified):
+        if not is_metadata(file) and file not in patched_sources:
+            final_reg[file] = digests[file][1]
     if output_path is None:
         output_path = config['id'] + '.teamod'
-    temp_dir = 'temp'
-    os.makedirs(temp_dir, exist_ok=True)
-    print("Copying files...")
-    for file in new + modified:
-        orig_file = file
-        if file.startswith('/') or file.startswith('\\'):
-            file = file[1:]
-        if "dump.teareg" in file or "mod.json" in file: # why is this necessary?
-            continue
-        if orig_file not in new_reg:
-            new_reg[orig_file] = hash(os.path.join(directory, file))
-        real_file = os.path.join(directory, file)
-        print(f'Copying {real_file} to {temp_dir}')
-        os.makedirs(os.path.join(temp_dir, os.path.dirname(file)), exist_ok=True)
-        shutil.copy(real_file, os.path.join(temp_dir, file))
-    print("Copying mod metadata...")
-    shutil.copy("packed.teareg", os.path.join(temp_dir, "packed.teareg"))
-    shutil.copy(config_path, os.path.join(temp_dir, "mod.json"))
     if pause_before_zip:
         input("       --- Paused ---\nInspect and modify files now, then press Enter to continue...")
-    print("Creating archive...")
-    shutil.make_archive(output_path, 'zip', temp_dir)
-    shutil.rmtree(temp_dir)
-    os.remove("packed.teareg")
-    shutil.rmtree('temp', ignore_errors=True)
-    shutil.move(output_path + '.zip', output_path) # shutil adds an extra .zip extension
-    print(f'{colorama.Fore.BLUE}Packaged to {output_path}!{colorama.Style.RESET_ALL}')
+    log("Creating archive...")
+    # modified files the game directory passed as delta_base still has the original of may go in as deltas
+    delta_files = [file for file in final_reg if file in modified] if delta_base is not None else []
+    members = []
+    for file in final_reg:
+        if file not in delta_files:
+            members.append((digests[file][0], file[1:] if file.startswith('/') or file.startswith('\\') else file))
+    deltas = {}
+    temp_path = output_path + '.tmp'
+    try:
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            progress = Progress('Adding', len(members) + len(delta_files))
+            with metrics.stage('zip'):
+                if can_write_compressed():
+                    results = ordered_map(compress_member, members, jobs, threads=True, weight=deflated_size, max_weight=parallel_deflate_memory)
+                else:
+                    results = ((zipfile.ZipInfo.from_file(path, arcname), None, 0.0) for path, arcname in members)
+                for (path, arcname), (zinfo, data, seconds) in zip(members, results):
+                    progress.update(path)
+                    start = time.perf_counter()
+                    if data is None:
+                        zf.write(path, arcname, zipfile.ZIP_STORED if is_stored(arcname) else zipfile.ZIP_DEFLATED)
+                    else:
+                        write_compressed_member(zf, zinfo, data)
+                    metrics.file('zip', arcname, zinfo.file_size, seconds + time.perf_counter() - start)
+            names = [file[1:] if file.startswith('/') or file.startswith('\\') else file for file in delta_files]
+            tasks = ((os.path.join(delta_base, name), digests[file][0], base_hashes[file]) for file, name in zip(delta_files, names))
+            with metrics.stage('delta'):
+                for file, name, delta in zip(delta_files, names, ordered_map(file_delta, tasks, jobs)):
+                    progress.update(digests[file][0])
+                    if delta is None:
+                        zf.write(digests[file][0], name, zipfile.ZIP_STORED if is_stored(name) else zipfile.ZIP_DEFLATED)
+                        continue
+                    zf.writestr('deltas/' + name + '.delta', delta)
+                    deltas[file] = {'base': base_hashes[file], 'hash': final_reg.pop(file)}
+            progress.close()
+            if len(deltas) > 0:
+                log(f'{len(deltas)} files added as deltas')
+            log("Adding mod metadata...")
+            zf.writestr('packed.teareg', json.dumps(final_reg))
+            if len(patches) > 0:
+                zf.writestr('packed.teapatch', json.dumps(patches))
+            if len(deltas) > 0:
+                zf.writestr('packed.teadelta', json.dumps(deltas))
+            zf.write(config_path, 'mod.json')
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, output_path)
+    log(f'{colorama.Fore.BLUE}Packaged to {output_path}!{colorama.Style.RESET_ALL}')
 
 danger_exts = ["dll", "exe", "bat"]
 
-def unpackage(input_dir: str, output: str, show_virus_warning: bool=True, interactive_warning: bool=False, temp_dir: str="temp", backup_dir: str="backup") -> Tuple[dict, dict]:
-    print(f"Unpackaging {input_dir}...")
-    print("Cleaning up...")
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    os.makedirs(temp_dir, exist_ok=True)
+def back_up(path, backup_path):
+    # moves path out of the way (it's about to be replaced anyway), copying only if the backup is on another drive
+    os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+    try:
+        os.replace(path, backup_path)
+    except OSError:
+        shutil.copy2(path, backup_path)
+
+def patch_installed_cx(path, patch):
+    # returns the patched file and the operations that couldn't be applied, or None if path already is the patched
+    # file (the mod was installed before) - inserts aren't idempotent, applying them again would double the nodes.
+    # mods made before the patched hash was recorded have no 'hash' and are always applied
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == patch.get('hash'):
+        return None
+    if digest != patch['base']:
+        warn(f'Warning: {path} has changed since the mod was made, merging the changes into it')
+    file = decode_cx(data)
+    return file, apply_cx_diff(file, patch['ops'])
+
+def rebuild_from_delta(base, delta, entry):
+    # the file a delta describes, or None if base isn't the file the delta was made against
+    if hashlib.sha256(base).hexdigest() != entry['base']:
+        return None
+    data = apply_delta(base, delta)
+    if hashlib.sha256(data).hexdigest() != entry['hash']:
+        return None
+    return data
+
+def extract_member(zf, zinfo, path, digest):
+    # streams a member to path, hashing it on the way. returns whether it matched the registry
+    h = hashlib.sha256()
+    with zf.open(zinfo) as src, open(path, 'wb') as f:
+        chunk = src.read(1024 * 1024)
+        while chunk != b'':
+            h.update(chunk)
+            f.write(chunk)
+            chunk = src.read(1024 * 1024)
+    return h.hexdigest() == digest
+
+def install_member(zf, zinfo, path, digest):
+    # like extract_member, but path only ever holds the whole member, a bad member or full disk leave it alone
+    temp_path = path + '.tmp'
+    try:
+        matched = extract_member(zf, zinfo, temp_path, digest)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return matched
+
+def unpackage(input_dir: str, output: str, show_virus_warning: bool=True, interactive_warning: bool=False, backup_dir: str="backup") -> Tuple[dict, dict]:
+    log(f"Unpackaging {input_dir}...")
     os.makedirs(backup_dir, exist_ok=True)
     os.makedirs(output, exist_ok=True)
-    shutil.unpack_archive(input_dir, temp_dir, format='zip')
-    reg = json.load(open('temp/packed.teareg'))
-    config = json.load(open('temp/mod.json'))
-    for file in reg:
-        orig_file = file
+    with zipfile.ZipFile(input_dir) as zf:
+        reg = json.loads(zf.read('packed.teareg'))
+        config = json.loads(zf.read('mod.json'))
+        progress = Progress('Installing', len(reg))
+        for file in reg:
+            progress.update(file)
+            orig_file = file
+            if file.startswith('/') or file.startswith('\\'):
+                file = file[1:]
+            for ext in danger_exts:
+                if file.lower().endswith(ext):
+                    if show_virus_warning:
+                        warn(f'Warning: {file} is a potentially dangerous file type')
+                    if interactive_warning:
+                        if input('Do you want to continue? (Y/n) ').lower() == 'n':
+                            return
+                        warn("Continuing, but be careful! Future warnings disabled.")
+                        interactive_warning = False
+            try:
+                zinfo = zf.getinfo(file)
+            except KeyError:
+                warn(f'Warning: {file} is in the registry but not in the archive, skipping')
+                continue
+            exist_path = os.path.join(output, file)
+            # only files of the same size can match, so most changed files never have to be read
+            if os.path.isfile(exist_path) and os.path.getsize(exist_path) == zinfo.file_size and hash(exist_path) == reg[orig_file]:
+                continue
+            os.makedirs(os.path.join(output, os.path.dirname(file)), exist_ok=True)
+            # the original is only backed up (moved away) once the new file is complete, so a bad member or a full
+            # disk leaves the game with the file it had
+            start = time.perf_counter()
+            try:
+                with metrics.stage('extract'):
+                    matched = extract_member(zf, zinfo, exist_path + '.tmp', reg[orig_file])
+                if os.path.exists(exist_path):
+                    with metrics.stage('backup'):
+                        back_up(exist_path, os.path.join(backup_dir, file))
+                os.replace(exist_path + '.tmp', exist_path)
+            finally:
+                if os.path.exists(exist_path + '.tmp'):
+                    os.remove(exist_path + '.tmp')
+            metrics.file('extract', file, zinfo.file_size, time.perf_counter() - start)
+            if not matched:
+                warn(f'Warning: {file} doesn\'t match the hash in the mod\'s registry')
+        progress.close()
+        deltas = json.loads(zf.read('packed.teadelta')) if 'packed.teadelta' in zf.namelist() else {}
+        for file, entry in deltas.items():
+            if file.startswith('/') or file.startswith('\\'):
+                file = file[1:]
+            exist_path = os.path.join(output, file)
+            if not os.path.isfile(exist_path):
+                warn(f'Warning: {file} doesn\'t exist, so the mod\'s changes to it can\'t be applied')
+                continue
+            with open(exist_path, 'rb') as f:
+                base = f.read()
+            if hashlib.sha256(base).hexdigest() == entry['hash']:
+                continue
+            start = time.perf_counter()
+            with metrics.stage('delta'):
+                data = rebuild_from_delta(base, zf.read('deltas/' + file + '.delta'), entry)
+            if data is None:
+                warn(f'Warning: {file} isn\'t the file the mod was made for, so the mod\'s changes to it can\'t be applied')
+                continue
+            log(f'Rebuilding {file}')
+            with open(exist_path + '.tmp', 'wb') as f:
+                f.write(data)
+            with metrics.stage('backup'):
+                back_up(exist_path, os.path.join(backup_dir, file))
+            os.replace(exist_path + '.tmp', exist_path)
+            metrics.file('delta', file, len(data), time.perf_counter() - start)
+        patches = json.loads(zf.read('packed.teapatch')) if 'packed.teapatch' in zf.namelist() else {}
+    for file, patch in patches.items():
         if file.startswith('/') or file.startswith('\\'):
             file = file[1:]
-        for ext in danger_exts:
-            if file.lower().endswith(ext):
-                if show_virus_warning:
-                    warn(f'Warning: {file} is a potentially dangerous file type')
-                if interactive_warning:
-                    if input('Do you want to continue? (Y/n) ').lower() == 'n':
-                        return
-                    warn("Continuing, but be careful! Future warnings disabled.")
-                    interactive_warning = False
         exist_path = os.path.join(output, file)
-        if hash(exist_path) == hash(os.path.join(temp_dir, file)):
-            print(f'{file} already exists and hashes match, skipping')
+        if not os.path.isfile(exist_path):
+            warn(f'Warning: {file} doesn\'t exist, so the mod\'s changes to it can\'t be applied')
             continue
-        if os.path.exists(exist_path):
-            print(f'Backing up {file} to {os.path.join(backup_dir, file)}')
-            os.makedirs(os.path.join(backup_dir, os.path.dirname(file)), exist_ok=True)
-            shutil.copy(os.path.join(output, file), os.path.join(backup_dir, file))
-        print(f'Copying {file} to {os.path.join(output, file)}')
-        os.makedirs(os.path.join(output, os.path.dirname(file)), exist_ok=True)
-        shutil.copy(os.path.join(temp_dir, file), os.path.join(output, file))
-    print("Cleaning up...")
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    print(f'{colorama.Fore.BLUE}Unpackaged to {output}!{colorama.Style.RESET_ALL}')
+        start = time.perf_counter()
+        with metrics.stage('patch'):
+            result = patch_installed_cx(exist_path, patch)
+            if result is None:
+                continue
+            log(f'Patching {file}')
+            patched, failed = result
+            if len(failed) > 0:
+                warn(f'Warning: {len(failed)} of the mod\'s changes to {file} couldn\'t be applied')
+            with open(exist_path + '.tmp', 'wb') as f:
+                write_cx(patched, f)
+        with metrics.stage('backup'):
+            back_up(exist_path, os.path.join(backup_dir, file))
+        os.replace(exist_path + '.tmp', exist_path)
+        metrics.file('patch', file, os.path.getsize(exist_path), time.perf_counter() - start)
+    log(f'{colorama.Fore.BLUE}Unpackaged to {output}!{colorama.Style.RESET_ALL}')
     return config, reg
 
-def revert_from_backup(backup_dir: str, output: str):
-    print(f"Reverting from backup {backup_dir} to {output}...")
-    for root, dirs, files in os.walk(backup_dir):
+# extracted mods are cached under cache_dir/<sha256 of the archive>, so an archive is only ever extracted once.
+# index.json remembers the (size, mtime, inode) each archive had when it was hashed, so unchanged archives
+# aren't even rehashed, and plans/ holds one activation plan per game directory + set of mods
+MOD_CACHE_VERSION = 1
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def load_mod_cache_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if index.get('version') != MOD_CACHE_VERSION:
+        return {}
+    return index['archives']
+
+def save_mod_cache_index(cache_dir, archives):
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump({'version': MOD_CACHE_VERSION, 'archives': archives}, f)
+
+def extract_mod(archive, mod_dir):
+    log(f'Extracting {archive} to {mod_dir}')
+    temp_dir = mod_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(temp_dir, 'files'))
+    with zipfile.ZipFile(archive) as zf:
+        reg = json.loads(zf.read('packed.teareg'))
+        for file in reg:
+            name = file[1:] if file.startswith('/') or file.startswith('\\') else file
+            try:
+                zinfo = zf.getinfo(name)
+            except KeyError:
+                warn(f'Warning: {name} is in the registry but not in the archive, skipping')
+                continue
+            path = os.path.join(temp_dir, 'files', name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not install_member(zf, zinfo, path, reg[file]):
+                warn(f'Warning: {name} doesn\'t match the hash in the mod\'s registry')
+        with open(os.path.join(temp_dir, 'packed.teareg'), 'wb') as f:
+            f.write(zf.read('packed.teareg'))
+        with open(os.path.join(temp_dir, 'mod.json'), 'wb') as f:
+            f.write(zf.read('mod.json'))
+        for name in zf.namelist():
+            if name in ('packed.teapatch', 'packed.teadelta') or name.startswith('deltas/'):
+                os.makedirs(os.path.dirname(os.path.join(temp_dir, name)), exist_ok=True)
+                with open(os.path.join(temp_dir, name), 'wb') as f:
+                    f.write(zf.read(name))
+    os.replace(temp_dir, mod_dir)
+
+def cached_mod(archive, cache_dir, archives):
+    # returns (digest, directory of the extracted mod), extracting the archive if it isn't cached yet
+    signature = file_signature(archive)
+    entry = archives.get(os.path.abspath(archive))
+    if entry is not None and entry[:3] == signature:
+        digest = entry[3]
+    else:
+        digest = hash(archive)
+        archives[os.path.abspath(archive)] = signature + [digest]
+    mod_dir = os.path.join(cache_dir, digest)
+    if not os.path.isdir(mod_dir):
+        with metrics.stage('extract'):
+            extract_mod(archive, mod_dir)
+    return digest, mod_dir
+
+def activation_plan(directory, mods, cache_dir):
+    # mods are (digest, mod_dir, config, reg, patches, deltas) in load order. the plan maps every file a mod
+    # overrides to the last mod providing it (files sent as deltas are rebuilt once, into cache_dir/files) - or,
+    # for CX patches, to the game's file (or a mod's) with every later patch applied, made once here - and lists
+    # the files the mods disagree about. it also remembers for each file whether the game's copy (as of the
+    # recorded signature) is identical to the mod's, so that needs no hashing the next time. returns the plan
+    # and where it's saved
+    key = hashlib.sha256('\n'.join([os.path.abspath(directory)] + [mod[0] for mod in mods]).encode()).hexdigest()
+    plan_path = os.path.join(cache_dir, 'plans', key + '.json')
+    try:
+        with open(plan_path, 'r') as f:
+            plan = json.load(f)
+        # patched files are only valid as long as the game files they were made from are unchanged
+        if all(os.path.isfile(path) and file_signature(path) == signature for path, signature in plan.get('bases', {}).items()):
+            return plan, plan_path
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    files = {}
+    providers = {} # name -> [(mod name, patch operations or None for the whole file, hash of the patched file)]
+    for digest, mod_dir, config, reg, patches, deltas in mods:
+        for file, file_hash in reg.items():
+            name = file[1:] if file.startswith('/') or file.startswith('\\') else file
+            files[name] = [os.path.join(mod_dir, 'files', name), file_hash, None, False]
+            providers.setdefault(name, []).append((config['name'], None, None))
+        for file, entry in deltas.items():
+            name = file[1:] if file.startswith('/') or file.startswith('\\') else file
+            source = os.path.join(cache_dir, 'files', entry['hash'])
+            if not os.path.isfile(source):
+                base_path = os.path.join(directory, name)
+                data = None
+                if os.path.isfile(base_path):
+                    with open(base_path, 'rb') as f:
+                        with open(os.path.join(mod_dir, 'deltas', name + '.delta'), 'rb') as delta:
+                            data = rebuild_from_delta(f.read(), delta.read(), entry)
+                if data is None:
+                    warn(f'Warning: {name} isn\'t the file {config["name"]} was made for, so its changes to it can\'t be applied')
+                    continue
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                with open(source, 'wb') as f:
+                    f.write(data)
+            files[name] = [source, entry['hash'], None, False]
+            providers.setdefault(name, []).append((config['name'], None, None))
+        for file, patch in patches.items():
+            name = file[1:] if file.startswith('/') or file.startswith('\\') else file
+            providers.setdefault(name, []).append((config['name'], patch['ops'], patch.get('hash')))
+    conflicts = {}
+    bases = {}
+    for name, entries in providers.items():
+        whole = [i for i, (mod_name, ops, patched_hash) in enumerate(entries) if ops is None]
+        # patches only apply on top of the last whole file, anything before that is lost
+        patches = entries[whole[-1] + 1:] if len(whole) > 0 else entries
+        lost = len(whole) > 0 and whole[-1] > 0
+        if lost or any(diffs_conflict(a[1], b[1]) for a, b in combinations(patches, 2)):
+            conflicts[name] = [mod_name for mod_name, ops, patched_hash in entries]
+        if len(patches) == 0:
+            continue
+        base = files[name][0] if name in files else os.path.join(directory, name)
+        if not os.path.isfile(base):
+            warn(f'Warning: {name} doesn\'t exist, so the changes to it can\'t be applied')
+            continue
+        if name not in files:
+            bases[os.path.abspath(base)] = file_signature(base)
+        file = read_cx_path(base)
+        base_hash = hash(base)
+        for mod_name, ops, patched_hash in patches:
+            # installed with unpackage already - applying it again would double its inserts
+            if patched_hash == base_hash:
+                continue
+            failed = apply_cx_diff(file, ops)
+            if len(failed) > 0:
+                warn(f'Warning: {len(failed)} of {mod_name}\'s changes to {name} couldn\'t be applied')
+        patched_path = os.path.join(cache_dir, 'patched', key, name)
+        os.makedirs(os.path.dirname(patched_path), exist_ok=True)
+        with open(patched_path, 'wb') as f:
+            write_cx(file, f)
+        files[name] = [patched_path, hash(patched_path), None, False]
+    return {'files': files, 'conflicts': conflicts, 'bases': bases}, plan_path
+
+def open_journal(backup_dir, directory, stage=None):
+    # every change a session makes is written here before it's made, so if the session never finishes (crash,
+    # power cut, killed from the task manager...) the next play can undo it with recover_session()
+    journal = open(os.path.join(backup_dir, 'session.journal'), 'w')
+    write_journal(journal, {'directory': os.path.abspath(directory), 'stage': stage})
+    return journal
+
+def write_journal(journal, entry):
+    journal.write(json.dumps(entry) + '\n')
+    journal.flush()
+
+def recover_session(backup_dir):
+    path = os.path.join(backup_dir, 'session.journal')
+    if not os.path.exists(path):
+        return
+    warn('Warning: the last session didn\'t finish, rolling it back...')
+    with open(path, 'r') as f:
+        entries = [json.loads(line) for line in f if line.endswith('\n')] # the last line may be cut off
+    if len(entries) > 0:
+        header = entries[0]
+        if header['stage'] is not None:
+            close_stage(header['stage'], header['directory'], [entry[0] for entry in entries[1:]])
+        else:
+            deactivate(header['directory'], entries[1:], backup_dir)
+    shutil.rmtree(backup_dir)
+
+def activate(directory, plan, backup_dir, journal):
+    # puts the planned files in place, moving the game's own copies into backup_dir. returns the files changed
+    # and whether the game had its own copy, for deactivate()
+    changed = []
+    for name, entry in plan['files'].items():
+        source, file_hash, signature, identical = entry
+        target = os.path.join(directory, name)
+        current = file_signature(target) if os.path.isfile(target) else None
+        if current != signature:
+            identical = current is not None and current[0] == os.path.getsize(source) and hash(target) == file_hash
+            entry[2], entry[3] = current, identical
+        if identical:
+            continue
+        write_journal(journal, [name, current is not None])
+        if current is not None:
+            back_up(target, os.path.join(backup_dir, name))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy(source, target)
+        changed.append((name, current is not None))
+    return changed
+
+def deactivate(directory, changed, backup_dir):
+    # moving the originals back (rather than copying) keeps their signatures, so the plan stays valid. files
+    # that are already back (or were never moved) are left alone, so this can also undo a half-done activate()
+    for name, had_original in changed:
+        target = os.path.join(directory, name)
+        backup = os.path.join(backup_dir, name)
+        if not had_original:
+            if os.path.exists(target):
+                os.remove(target)
+        elif os.path.exists(backup):
+            try:
+                os.replace(backup, target)
+            except OSError:
+                shutil.copy2(backup, target)
+
+FICLONE = 0x40049409
+
+def link_file(source, target, clone=False):
+    # gets source's contents to target as cheaply as possible. with clone, writes to target must never reach
+    # source, so it's a copy-on-write clone (reflink) where the filesystem supports it and a plain copy where it
+    # doesn't. otherwise it's a hardlink, or a plain copy if even that's unsupported (different drives, FAT...).
+    # returns which one it used
+    if clone:
+        if fcntl is not None:
+            try:
+                with open(source, 'rb') as src, open(target, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return 'cloned'
+            except OSError:
+                if os.path.exists(target):
+                    os.remove(target)
+        shutil.copy2(source, target)
+        return 'copied'
+    try:
+        os.link(source, target)
+        return 'linked'
+    except OSError:
+        shutil.copy2(source, target)
+        return 'copied'
+
+def build_stage(directory, plan, stage, journal):
+    # the staged tree is the game directory made of links to the game's own files, with the mod files in
+    # place of the ones they override. nothing is copied unless linking isn't possible, so this takes about
+    # as long for a 1GB mod as for a 1KB one
+    shutil.rmtree(stage, ignore_errors=True)
+    counts = {'cloned': 0, 'linked': 0, 'copied': 0}
+    for root, dirs, files in os.walk(directory):
+        rel = os.path.relpath(root, directory)
+        os.makedirs(os.path.join(stage, rel), exist_ok=True)
+        for file in files:
+            name = os.path.normpath(os.path.join(rel, file)).replace('\\', '/')
+            if name in plan['files']:
+                continue
+            counts[link_file(os.path.join(root, file), os.path.join(stage, rel, file))] += 1
+    for name, entry in plan['files'].items():
+        write_journal(journal, [name])
+        target = os.path.join(stage, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # mod files are never hardlinked, or the game could write through to the cache
+        counts[link_file(entry[0], target, clone=True)] += 1
+    log(f'Staged {stage} ({counts["linked"]} linked, {counts["cloned"]} cloned, {counts["copied"]} copied)')
+
+def close_stage(stage, directory, mod_files):
+    # anything the game wrote into the staged tree that isn't the game's own file anymore (saves, settings,
+    # logs...) is moved back into the game directory before the stage is removed. mod files stay out of it
+    mod_files = set(mod_files)
+    for root, dirs, files in os.walk(stage):
+        rel = os.path.relpath(root, stage)
         for file in files:
-            backup_file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(backup_file_path, backup_dir)
-            output_file_path = os.path.join(output, relative_path)
-            os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-            shutil.copy(backup_file_path, output_file_path)
-    print(f"{colorama.Fore.BLUE}Reverted {output}!{colorama.Style.RESET_ALL}")
-
-def play(directory: str, mods: str):
-    print(f'Loading mods...')
+            name = os.path.normpath(os.path.join(rel, file)).replace('\\', '/')
+            if name in mod_files:
+                continue
+            path = os.path.join(root, file)
+            target = os.path.join(directory, name)
+            if os.path.exists(target):
+                if os.path.samefile(path, target):
+                    continue
+                st, target_st = os.stat(path), os.stat(target)
+                if st.st_size == target_st.st_size and st.st_mtime_ns == target_st.st_mtime_ns: # an unchanged copy
+                    continue
+            log(f'Keeping {name}')
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.replace(path, target)
+            except OSError:
+                shutil.copy2(path, target)
+    shutil.rmtree(stage, ignore_errors=True)
+
+def play(directory: str, mods: str, cache_dir: str="modcache", overlay: bool=False):
+    log(f'Loading mods...')
     backup_dir = 'backup'
+    with metrics.stage('recover'):
+        recover_session(backup_dir)
     os.makedirs(backup_dir, exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, 'plans'), exist_ok=True)
+    archives = load_mod_cache_index(cache_dir)
+    loaded = []
     for root, dirs, files in os.walk(mods):
-        for file in files:
+        dirs.sort()
+        for file in sorted(files):
             if not file.endswith('.teamod'):
                 continue
-            mod_path = os.path.join(root, file)
-            config, reg = unpackage(mod_path, directory, show_virus_warning=False, interactive_warning=False, backup_dir=backup_dir)
-            print("Loaded mod: " + config['name'] + " by " + config['author'] + " v" + str(config['version']))
-    print("Mods loaded!")
-    print("Starting Tea for God...")
-    old_dir = os.getcwd()
-    os.chdir(directory)
-    print(f"Currently in {os.getcwd()}")
-    if os.path.exists("tfg.exe"):
-        subprocess.run("tfg.exe")
-    elif os.path.exists("tea.exe"):
-        subprocess.run("tea.exe")
+            digest, mod_dir = cached_mod(os.path.join(root, file), cache_dir, archives)
+            with open(os.path.join(mod_dir, 'mod.json'), 'r') as f:
+                config = json.load(f)
+            with open(os.path.join(mod_dir, 'packed.teareg'), 'r') as f:
+                reg = json.load(f)
+            patches = {}
+            if os.path.exists(os.path.join(mod_dir, 'packed.teapatch')):
+                with open(os.path.join(mod_dir, 'packed.teapatch'), 'r') as f:
+                    patches = json.load(f)
+            deltas = {}
+            if os.path.exists(os.path.join(mod_dir, 'packed.teadelta')):
+                with open(os.path.join(mod_dir, 'packed.teadelta'), 'r') as f:
+                    deltas = json.load(f)
+            loaded.append((digest, mod_dir, config, reg, patches, deltas))
+            log("Loaded mod: " + config['name'] + " by " + config['author'] + " v" + str(config['version']))
+    save_mod_cache_index(cache_dir, archives)
+    with metrics.stage('plan'):
+        plan, plan_path = activation_plan(directory, loaded, cache_dir)
+    for name, names in plan['conflicts'].items():
+        warn(f'Warning: {name} is changed by {", ".join(names)} - where they disagree, {names[-1]} wins')
+    if overlay:
+        stage = os.path.abspath(directory).rstrip('/\\') + '.teastage'
+        journal = open_journal(backup_dir, directory, stage)
+        with metrics.stage('activate'):
+            build_stage(directory, plan, stage, journal)
     else:
-        print("Couldn't find main executable!")
+        journal = open_journal(backup_dir, directory)
+        with metrics.stage('activate'):
+            changed = activate(directory, plan, backup_dir, journal)
+    with open(plan_path, 'w') as f:
+        json.dump(plan, f)
+    log("Mods loaded!")
+    log("Starting Tea for God...")
+    old_dir = os.getcwd()
+    os.chdir(stage if overlay else directory)
+    log(f"Currently in {os.getcwd()}")
+    with metrics.stage('game'):
+        if os.path.exists("tfg.exe"):
+            subprocess.run("tfg.exe")
+        elif os.path.exists("tea.exe"):
+            subprocess.run("tea.exe")
+        else:
+            err("Couldn't find main executable!")
     os.chdir(old_dir)
-    print("Reverting from backup...")
-    revert_from_backup(backup_dir, directory)
+    with metrics.stage('restore'):
+        if overlay:
+            log("Removing staged game directory...")
+            close_stage(stage, directory, plan['files'])
+        else:
+            log("Reverting from backup...")
+            deactivate(directory, changed, backup_dir)
+    journal.close()
     shutil.rmtree(backup_dir)
@@ -0,0 +1,34 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+def ordered_map(fn, args_list, jobs=None, threads=False, window=4, weight=None, max_weight=None):
+    # like itertools.starmap(fn, args_list), but spread over worker processes (or threads). at most
+    # jobs * window calls are in flight at once, so args_list can be a lazy generator of any length, and
+    # results always come back in the same order as their arguments. with weight and max_weight, fewer are
+    # in flight once the weight(*args) of those adds up to max_weight (e.g. bytes a result holds in memory).
+    if jobs is None:
+        jobs = default_jobs()
+    if jobs <= 1:
+        for args in args_list:
+            yield fn(*args)
+        return
+    executor = ThreadPoolExecutor(max_workers=jobs) if threads else ProcessPoolExecutor(max_workers=jobs)
+    pending = deque()
+    in_flight = 0
+    try:
+        for args in args_list:
+            cost = weight(*args) if weight is not None else 0
+            pending.append((executor.submit(fn, *args), cost))
+            in_flight += cost
+            while len(pending) >= jobs * window or (max_weight is not None and pending and in_flight >= max_weight):
+                future, cost = pending.popleft()
+                in_flight -= cost
+                yield future.result()
+        while pending:
+            yield pending.popleft()[0].result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,154 @@
+import colorama
+import json
+import os
+import sqlite3
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+class Registry:
+    # path -> (size, mtime, hash, format) for every file of a game directory. stored in SQLite with the path as
+    # the primary key, so lookups, directory listings and diffs don't need the whole registry in memory.
+    # the old JSON registries ({path: hash}) can still be loaded and written, see load_registry() and save_json().
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT, format TEXT) WITHOUT ROWID')
+
+    @staticmethod
+    def create(path, entries=()):
+        # replaces whatever is at path (including old JSON registries) once the new registry is complete
+        temp_path = path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        reg = Registry(temp_path)
+        reg.update(entries)
+        reg.close()
+        os.replace(temp_path, path)
+        return Registry(path)
+
+    @staticmethod
+    def from_json(json_path, path=':memory:'):
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        reg = Registry(path)
+        reg.update((file, None, None, digest, None) for file, digest in data.items())
+        return reg
+
+    def update(self, entries):
+        # entries are (path, size, mtime, hash, format) tuples
+        self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', entries)
+        self.db.commit()
+
+    def set(self, path, hash, size=None, mtime=None, format=None):
+        self.update([(path, size, mtime, hash, format)])
+
+    def get(self, path, default=None):
+        row = self.db.execute('SELECT hash FROM files WHERE path = ?', (path,)).fetchone()
+        return default if row is None else row[0]
+
+    def entry(self, path):
+        row = self.db.execute('SELECT path, size, mtime, hash, format FROM files WHERE path = ?', (path,)).fetchone()
+        return None if row is None else dict(zip(('path', 'size', 'mtime', 'hash', 'format'), row))
+
+    def __getitem__(self, path):
+        row = self.db.execute('SELECT hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return row[0]
+
+    def __contains__(self, path):
+        return self.db.execute('SELECT 1 FROM files WHERE path = ?', (path,)).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self.db.execute('SELECT path FROM files ORDER BY path'))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def items(self):
+        return self.db.execute('SELECT path, hash FROM files ORDER BY path').fetchall()
+
+    def prefix(self, directory):
+        # every path under a directory, as a range scan over the primary key
+        directory = directory.replace('\\', '/').rstrip('/')
+        if directory == '':
+            return list(self)
+        start = directory + '/'
+        end = directory + chr(ord('/') + 1)
+        return [row[0] for row in self.db.execute('SELECT path FROM files WHERE path >= ? AND path < ? ORDER BY path', (start, end))]
+
+    def entries(self):
+        # path -> (size, mtime, hash) for every file, in one query
+        return {row[0]: row[1:] for row in self.db.execute('SELECT path, size, mtime, hash FROM files')}
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def diff(self, other):
+        # returns (new, modified, deleted) paths in other compared to this registry. other's database is attached
+        # and compared with joins on path, so neither registry is loaded into memory. an in-memory registry (one
+        # loaded from JSON) can't be attached, so its rows are copied into an attached in-memory database instead
+        if other.path == ':memory:':
+            self.db.execute("ATTACH DATABASE ':memory:' AS other")
+            self.db.execute('CREATE TABLE other.files (path TEXT PRIMARY KEY, hash TEXT) WITHOUT ROWID')
+            self.db.executemany('INSERT INTO other.files VALUES (?, ?)', other.db.execute('SELECT path, hash FROM files'))
+        else:
+            self.db.execute('ATTACH DATABASE ? AS other', (other.path,))
+        try:
+            added = [row[0] for row in self.db.execute('SELECT new.path FROM other.files new LEFT JOIN main.files old ON old.path = new.path WHERE old.path IS NULL ORDER BY new.path')]
+            modified = [row[0] for row in self.db.execute('SELECT new.path FROM other.files new JOIN main.files old ON old.path = new.path WHERE old.hash IS NOT new.hash ORDER BY new.path')]
+            deleted = [row[0] for row in self.db.execute('SELECT old.path FROM main.files old LEFT JOIN other.files new ON new.path = old.path WHERE new.path IS NULL ORDER BY old.path')]
+        finally:
+            self.db.commit()
+            self.db.execute('DETACH DATABASE other')
+        return added, modified, deleted
+
+    def save_json(self, json_path):
+        with open(json_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def is_sqlite_registry(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+def load_registry(path):
+    # works with both the SQLite registries and the old JSON ones
+    if is_sqlite_registry(path):
+        return Registry(path)
+    return Registry.from_json(path)
+
+def export_registry(reg_path, output):
+    with load_registry(reg_path) as reg:
+        reg.save_json(output)
+        print(f'{colorama.Fore.BLUE}Exported {len(reg)} entries to {output}!{colorama.Style.RESET_ALL}')
+
+def import_registry(json_path, output):
+    with Registry.from_json(json_path) as reg:
+        entries = reg.db.execute('SELECT path, size, mtime, hash, format FROM files').fetchall()
+    with Registry.create(output, entries) as reg:
+        print(f'{colorama.Fore.BLUE}Imported {len(reg)} entries to {output}!{colorama.Style.RESET_ALL}')
+
+def list_registry(reg_path, directory=''):
+    with load_registry(reg_path) as reg:
+        for path in reg.prefix(directory):
+            print(f'{reg[path]}  {path}')
+
+def diff_registries(old_path, new_path):
+    with load_registry(old_path) as old, load_registry(new_path) as new:
+        added, modified, deleted = old.diff(new)
+    for path in added:
+        print(colorama.Fore.GREEN + '+ ' + path + colorama.Style.RESET_ALL)
+    for path in modified:
+        print(colorama.Fore.YELLOW + '~ ' + path + colorama.Style.RESET_ALL)
+    for path in deleted:
+        print(colorama.Fore.RED + '- ' + path + colorama.Style.RESET_ALL)
+    print(f'{len(added)} new, {len(modified)} modified, {len(deleted)} deleted')